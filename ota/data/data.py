@@ -27,6 +27,7 @@ class Data():
         self.start_frame = None
         self.torsion = None
         self.pupil_list = None
+        self.frame_offset = None
 
         # If save path is not specified, set it to the current directory
         if path is not None:
@@ -34,7 +35,7 @@ class Data():
         else:
             self.path = os.path.curdir
 
-    def set(self, torsion, start_frame=0, pupil_list=None, metadata=None, frame_index_list=None):
+    def set(self, torsion, start_frame=0, pupil_list=None, metadata=None, frame_index_list=None, frame_offset=None):
         """
         Populate data fields with values.
 
@@ -51,12 +52,17 @@ class Data():
         frame_index_list : list
             List of same length as torsion. Maps torsion values to corresponding video frame indeces.
             Specified when the video frames analyzed are not just subsequent frames.
+        frame_offset : dict
+            Position of the analyzed region of interest in the full video frame,
+            {'c': column index, 'r': row index}. Pupil coordinates are saved in full
+            frame space by adding this offset. Specified when the video was cropped.
         """
         self.metadata = metadata
         self.start_frame = start_frame
         self.torsion = torsion
         self.frame_index_list = frame_index_list
         self.pupil_list = pupil_list
+        self.frame_offset = frame_offset
 
     def save(self):
         """
@@ -117,6 +123,12 @@ class Data():
             # default time is empty string
             time = ''
 
+            # pupil coordinates are reported in full frame space
+            if self.frame_offset is None:
+                offset_col, offset_row = 0, 0
+            else:
+                offset_col, offset_row = self.frame_offset['c'], self.frame_offset['r']
+
             # save to csv
             for i, deg in enumerate(self.torsion):
                 # Check if a specific frame index list exists or not
@@ -136,8 +148,8 @@ class Data():
                     pupil_radius = ''
                 else:
                     temp_pupil = self.pupil_list[i+self.start_frame]
-                    pupil_center_col = temp_pupil.center_col
-                    pupil_center_row = temp_pupil.center_row
+                    pupil_center_col = temp_pupil.center_col + offset_col
+                    pupil_center_row = temp_pupil.center_row + offset_row
                     pupil_radius = temp_pupil.radius
 
                 # Find the change in angle
@@ -0,0 +1,103 @@
+from ota.eyelid import eyelid
+from ota.eyelid import keyframes as kf
+from ota.execution import stage_executor as stg
+from tqdm import tqdm
+
+def construct_eyelid_list(video, first_frame, last_frame, pupil_list, keyframes=None, executor=None, workers=None, method='hough',
+                          blink_filter=None, **kw):
+    '''
+    Construct dictionaries of the eyelids and blinks for a series of video frames.
+
+    Inputs:
+        video - video object
+        first_frame - Integer representing index of first frame to analyze.
+        last_frame - Integer representing index of last frame to analyze.
+        pupil_list - dictionary (or PupilTrack) of pupil objects of the frames
+        keyframes - if given, an integer keyframe interval or a keyframes.EyelidKeyframes
+                object. The full eyelid detector is only run on keyframes and the eyelids
+                of the other frames are interpolated, see keyframes.EyelidKeyframes.
+        executor - 'thread' or a stage_executor.StageExecutor object to detect the
+                eyelids in a thread pool, not used in keyframe mode
+        workers - number of worker threads if executor is 'thread'
+        method - eyelid detector, 'hough' (eyelid.detect_eyelid) or 'fast'
+                (eyelid.detect_eyelid_fast)
+        blink_filter - optional blink.BlinkFilter. The eyelids of the frames it flags
+                as blinks are not detected, and the frames are None in both lists. Only
+                the eyelid detection is skipped, the pupils are already in pupil_list,
+                and as the statistics are measured around the pupil of each frame mostly
+                the iris intensity test flags frames. To also skip the pupil detection,
+                pass the filter to pupil_locate.construct_pupil_list. Not used with an
+                executor.
+        kw - eyelid detection parameters, see eyelid.detect_eyelid
+
+    Outputs:
+        eyelid_list: Dictionary of Eyelid objects where the key is the frame number and the
+                     value is the eyelid object, None if the eyelids were not found.
+        blink_list: Dictionary where the key is the frame number and the value is 1 if the
+                    pupil is obstructed, 0 if not and None if the frame can not be used.
+    '''
+    detector = eyelid.DETECTORS[method]
+
+    def detect(frame, pupil_i):
+        return detector(frame, pupil_i, **kw)
+
+    def is_blink(frame, pupil_i):
+        if blink_filter is None:
+            return False
+        # the pupils are known, the statistics are measured around the pupil of the frame
+        if blink_filter.is_blink(frame, pupil_i or None):
+            return True
+        if pupil_i:
+            blink_filter.update(frame, pupil_i)
+        return False
+
+    eyelid_list = {}
+
+    if keyframes is not None:
+        if isinstance(keyframes, int):
+            keyframes = kf.EyelidKeyframes(detect, interval=keyframes)
+
+        for i, frame in tqdm(enumerate(video[first_frame:last_frame+1])):
+            frame_loc = i + first_frame
+            pupil_i = None if is_blink(frame, pupil_list[frame_loc]) else pupil_list[frame_loc]
+            eyelid_list.update(keyframes.push(frame_loc, frame, pupil_i))
+        eyelid_list.update(keyframes.flush())
+
+    else:
+        def stage(frame_loc, frame):
+            # check if a pupil exists
+            if not pupil_list[frame_loc] or is_blink(frame, pupil_list[frame_loc]):
+                return None
+            try:
+                return detect(frame, pupil_list[frame_loc])
+            except:
+                return None
+
+        if executor is None:
+            results = ((i + first_frame, stage(i + first_frame, frame)) for i, frame in enumerate(video[first_frame:last_frame+1]))
+        else:
+            if executor == 'thread':
+                executor = stg.StageExecutor(workers)
+            elif not isinstance(executor, stg.StageExecutor):
+                raise ValueError("executor must be 'thread' or a StageExecutor, not {!r}".format(executor))
+            # the filter is stateful and the executor processes frames out of order
+            blink_filter = None
+            results = executor.run(video, first_frame, last_frame, [('eyelid', stage)])
+
+        for frame_loc, eyelid_i in tqdm(results):
+            eyelid_list[frame_loc] = eyelid_i
+
+    blink_list = {}
+    for frame_loc in range(first_frame, last_frame + 1):
+        eyelid_i = eyelid_list.get(frame_loc)
+        if eyelid_i is None or not pupil_list[frame_loc]:
+            blink_list[frame_loc] = None
+        else:
+            blink_list[frame_loc] = eyelid.pupil_obstruct(eyelid_i, pupil_list[frame_loc].contour)
+
+        # the frame before a blink or an unusable frame is not used either
+        if (frame_loc - first_frame > 2 and blink_list[frame_loc] == 1) or blink_list[frame_loc] is None:
+            if frame_loc - 1 in blink_list:
+                blink_list[frame_loc - 1] = None
+
+    return eyelid_list, blink_list
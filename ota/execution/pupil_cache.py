@@ -0,0 +1,232 @@
+'''
+Persistent on-disk cache of pupil detection results.
+
+Results are stored per video and detection settings as compressed npz files of a
+PupilTrack, with a flag per frame recording whether the frame was analyzed. A video
+is identified by a hash of sampled blocks of its file(s), so a renamed or copied
+recording still hits the cache while an edited one does not.
+'''
+import hashlib
+import os
+
+import numpy as np
+
+from ota.execution import pupil_locate as pl
+from ota.pupil import track as trk
+from ota import presets as pre
+
+CACHE_EXTENSION = '.npz'
+
+def video_fingerprint(video, num_samples=16, block_size=64*1024):
+    '''
+    Fast content hash of a video, computed from num_samples blocks of block_size bytes
+    spread evenly over the video file(s) and their sizes. Videos without a file are
+    hashed from num_samples of their frames.
+
+    Inputs:
+        video - Video, SegmentedVideo, FrameStore or ArrayVideo object
+
+    Outputs:
+        fingerprint - hexadecimal digest
+    '''
+    digest = hashlib.sha1()
+
+    paths = getattr(video, 'paths', None) or ([video.path] if getattr(video, 'path', None) else [])
+
+    if paths:
+        for path in paths:
+            size = os.path.getsize(path)
+            digest.update(str(size).encode())
+            with open(path, 'rb') as f:
+                for offset in np.unique(np.linspace(0, max(size - block_size, 0), num_samples, dtype=np.int64)):
+                    f.seek(int(offset))
+                    digest.update(f.read(block_size))
+    else:
+        frames = video.frames
+        digest.update(str(frames.shape).encode())
+        for i in np.unique(np.linspace(0, len(frames) - 1, num_samples, dtype=np.int64)):
+            digest.update(np.ascontiguousarray(frames[i]).tobytes())
+
+    return digest.hexdigest()
+
+def missing_ranges(computed, first_frame):
+    '''
+    Returns the inclusive (first, last) frame ranges where computed is False.
+    '''
+    edges = np.diff(np.concatenate(([0], (~computed).view(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    stops = np.flatnonzero(edges == -1)
+    return [(first_frame + int(a), first_frame + int(b) - 1) for a, b in zip(starts, stops)]
+
+class PupilCache:
+    '''
+    Size bounded on-disk cache of construct_pupil_list results.
+
+    Entries are keyed by the video fingerprint, the region of interest of the video and
+    the detection settings. When the cache is full the least recently used entries,
+    by file modification time, are removed.
+    '''
+
+    def __init__(self, cache_dir=pre.PUPIL_CACHE_DIR, max_bytes=pre.PUPIL_CACHE_SIZE):
+        '''
+        Inputs:
+            cache_dir - directory of the cache files, created if needed
+            max_bytes - maximum total size of the cache files
+
+        Attributes:
+            hits - number of frames read from the cache
+            misses - number of frames detected
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # the pupil lists are stored as compact tracks, see construct_pupil_list. The
+        # contours are only decimated if pre.PUPIL_CONTOUR_STEP is above 1.
+        self.contour_step = pre.PUPIL_CONTOUR_STEP
+        self.hits = 0
+        self.misses = 0
+
+        # fingerprints of the video files already hashed, by path, size and mtime
+        self._fingerprints = {}
+
+    def fingerprint(self, video):
+        '''
+        Returns the fingerprint of a video, see video_fingerprint.
+        '''
+        paths = getattr(video, 'paths', None) or ([video.path] if getattr(video, 'path', None) else [])
+        if not paths:
+            return video_fingerprint(video)
+
+        key = tuple((os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)) for path in paths)
+        if key not in self._fingerprints:
+            self._fingerprints[key] = video_fingerprint(video)
+        return self._fingerprints[key]
+
+    def entry_path(self, video, threshold, method='ellipse', track=False, pyramid_levels=0):
+        '''
+        Returns the location of the cache file of a video and detection settings.
+        '''
+        settings = repr((threshold, method, bool(track), pyramid_levels, self.contour_step, getattr(video, 'roi', None)))
+        key = hashlib.sha1(settings.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, '{}_{}{}'.format(self.fingerprint(video), key, CACHE_EXTENSION))
+
+    def construct_pupil_list(self, video, first_frame, last_frame, threshold=10, track=False, method='ellipse', pyramid_levels=0, **kwargs):
+        '''
+        Construct the pupil list of a series of video frames, detecting the pupils only
+        in the frames that are not in the cache, and store the result in the cache.
+
+        Inputs:
+            video - video object
+            first_frame - Integer representing index of first frame to analyze.
+            last_frame - Integer representing index of last frame to analyze.
+            threshold, track, method, pyramid_levels - detection settings, see
+                pupil_locate.construct_pupil_list
+            kwargs - other parameters passed on to pupil_locate.construct_pupil_list,
+                such as batch_size or workers
+
+        Outputs:
+            pupil_list - PupilTrack over [first_frame, last_frame]
+        '''
+        path = self.entry_path(video, threshold, method, track, pyramid_levels)
+        cached, computed = self.__load(path)
+
+        # frame span covering both the cached and the requested frames
+        if cached is None:
+            lo, hi = first_frame, last_frame
+        else:
+            lo, hi = min(first_frame, cached.first_frame), max(last_frame, cached.first_frame + len(cached) - 1)
+
+        merged = trk.PupilTrack(lo, hi, self.contour_step)
+        done = np.zeros(hi - lo + 1, dtype=bool)
+        if cached is not None:
+            merged.update(cached)
+            done[cached.first_frame - lo:cached.first_frame - lo + len(cached)] = computed
+
+        requested = done[first_frame - lo:last_frame - lo + 1]
+        ranges = missing_ranges(requested, first_frame)
+        self.hits += int(requested.sum())
+
+        for first, last in ranges:
+            pupil_list = pl.construct_pupil_list(video, first, last, threshold, track=track, method=method,
+                                                 pyramid_levels=pyramid_levels, compact=True, **kwargs)
+            merged.update(pupil_list)
+            done[first - lo:last - lo + 1] = True
+            self.misses += last - first + 1
+
+        if ranges:
+            merged.pack()
+            self.__save(path, merged, done)
+
+        return merged.select(first_frame, last_frame)
+
+    def __load(self, path):
+        if not os.path.isfile(path):
+            return None, None
+
+        try:
+            with np.load(path) as entry:
+                cached = trk.from_arrays(entry['records'], entry['points'], entry['offsets'], self.contour_step)
+                computed = entry['computed']
+        except (OSError, KeyError, ValueError):
+            # unreadable entry, it is recomputed
+            return None, None
+
+        # mark the entry as recently used
+        os.utime(path)
+        return cached, computed
+
+    def __save(self, path, track, computed):
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # write to a temporary file so that an interrupted write does not leave a corrupt entry
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            np.savez_compressed(f, records=track.records, points=track.points, offsets=track.offsets, computed=computed)
+        os.replace(temp_path, path)
+
+        self.evict(keep=path)
+
+    def entries(self):
+        '''
+        Returns the paths of the cache files, least recently used first.
+        '''
+        if not os.path.isdir(self.cache_dir):
+            return []
+        paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith(CACHE_EXTENSION)]
+        return sorted(paths, key=os.path.getmtime)
+
+    def size(self):
+        '''
+        Returns the total size of the cache files in bytes.
+        '''
+        return sum(os.path.getsize(path) for path in self.entries())
+
+    def evict(self, keep=None):
+        '''
+        Remove the least recently used cache files until the cache fits in max_bytes.
+        The file keep is never removed.
+        '''
+        paths = self.entries()
+        total = sum(os.path.getsize(path) for path in paths)
+        for path in paths:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+    def invalidate(self, video=None):
+        '''
+        Remove the cached results of a video for every detection setting, or the whole
+        cache if no video is given.
+        '''
+        prefix = '' if video is None else self.fingerprint(video) + '_'
+        for path in self.entries():
+            if os.path.basename(path).startswith(prefix):
+                os.remove(path)
+
+    def statistics(self):
+        '''
+        Returns a dictionary of the number of frames read from the cache and detected.
+        '''
+        return {'hits': self.hits, 'misses': self.misses}
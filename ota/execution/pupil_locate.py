@@ -1,10 +1,18 @@
 from ota.video import video as vid
 from ota.pupil import pupil
+from ota.pupil import track as trk
+from ota.execution import stage_executor as stg
 from ota.iris import iris
 from ota.data import data as dat
+from ota import presets as pre
 from tqdm import tqdm
+import multiprocessing
+import numpy as np
+import cv2
 
-def construct_pupil_list(video, first_frame, last_frame, threshold=10):
+def construct_pupil_list(video, first_frame, last_frame, threshold=10, track=False, batch_size=None, method='ellipse', pyramid_levels=0,
+                         workers=None, chunk_size=None, compact=False, predictor=None, executor='process',
+                         blink_filter=None, verbose=True):
     '''
     Construct a dictionary of pupil objects for a series of video frames.
 
@@ -12,21 +20,374 @@ def construct_pupil_list(video, first_frame, last_frame, threshold=10):
         video - video object
         first_frame - Integer representing index of first frame to analyze.
         last_frame - Integer representing index of last frame to analyze.
+        threshold - pupil detection threshold
+        track - if True, search for the pupil only in a window around the pupil of
+                the previous frame (sized from its major axis). The full frame is
+                searched when there is no previous pupil, or when the pupil is not
+                found inside the window or touches its edge.
+        batch_size - if given, frames are read and processed in stacks of batch_size
+                frames with pupil.detect_pupils. track, pyramid_levels, predictor and
+                blink_filter can not be used in batch mode.
+        method - pupil estimator, 'ellipse' (contour ellipse fit) or 'moments'
+                (image moments of the largest dark blob), see pupil.Pupil
+        pyramid_levels - if nonzero, full frame searches first locate the pupil on the
+                frame downscaled by 2**pyramid_levels and refine it at full resolution,
+                see pupil.Pupil.
+        workers - if given, the range is split into contiguous chunks processed by
+                workers worker processes, each with its own copy of the video. Missing
+                pupils are reported once per chunk. Tracking restarts at every chunk.
+        chunk_size - number of frames per worker chunk, by default the range is split
+                into four chunks per worker
+        executor - 'process' to run the workers, if any, in a process pool, 'thread' to
+                run the detection in a thread pool of workers threads (by default one per
+                core, see stage_executor.StageExecutor), or a StageExecutor object. Threads
+                avoid pickling frames and results. They process the frames out of order, so
+                track, batch_size, predictor and blink_filter can not be used with them.
+        compact - if True, return a PupilTrack keeping the pupil properties in one
+                array and the contours in one point buffer, instead of a dictionary of
+                pupil objects. See pre.PUPIL_CONTOUR_STEP for decimated contours.
+        predictor - optional motion.MotionPredictor. Frames where the pupil barely moves
+                and the image around it is unchanged reuse the predicted pupil instead of
+                being detected. The predictor counts the predicted and detected frames.
+                Can not be used with workers or in batch mode.
+        blink_filter - optional blink.BlinkFilter. Frames it flags as blinks are not
+                analyzed and their pupil is None. Can not be used with workers or in batch
+                mode.
+        verbose - if True, print a message for every frame without a pupil
 
     Outputs:
         pupil_list: Dictionary of pupil objects where the key is the frame number and the value is the pupil object.
+                    PupilTrack with the same interface if compact is True.
     '''
 
-    pupil_list = {}
+    if executor == 'thread':
+        executor = stg.StageExecutor(workers)
+    elif executor != 'process' and not isinstance(executor, stg.StageExecutor):
+        raise ValueError("executor must be 'process', 'thread' or a StageExecutor, not {!r}".format(executor))
+
+    # options that a mode does not support are rejected rather than ignored
+    options = {'track': track, 'batch_size': batch_size, 'pyramid_levels': pyramid_levels,
+               'predictor': predictor, 'blink_filter': blink_filter}
+    modes = [('a thread executor', executor != 'process', ('track', 'batch_size', 'predictor', 'blink_filter')),
+             ('workers', executor == 'process' and workers, ('predictor', 'blink_filter')),
+             ('batch_size', executor == 'process' and batch_size, ('track', 'pyramid_levels', 'predictor', 'blink_filter'))]
+    for mode, active, excluded in modes:
+        used = [name for name in excluded if options[name] is not None and options[name] is not False and options[name] != 0]
+        if active and used:
+            raise ValueError('{} can not be used with {}'.format(', '.join(used), mode))
+
+    if executor != 'process':
+        return construct_pupil_list_threaded(video, first_frame, last_frame, executor, threshold=threshold, method=method,
+                                             pyramid_levels=pyramid_levels, compact=compact, verbose=verbose)
+
+    if workers:
+        return construct_pupil_list_parallel(video, first_frame, last_frame, workers, chunk_size,
+                                             threshold=threshold, track=track, batch_size=batch_size,
+                                             method=method, pyramid_levels=pyramid_levels, compact=compact)
+
+    if batch_size:
+        return construct_pupil_list_batch(video, first_frame, last_frame, threshold, batch_size, method=method,
+                                          compact=compact, verbose=verbose)
+
+    pupil_list = empty_pupil_list(first_frame, last_frame, compact)
+    previous = None
 
     for i,frame in tqdm(enumerate(video[first_frame:last_frame+1])):
         frame_loc = i + first_frame
+        pupil_i = None
+
+        if blink_filter is not None and blink_filter.is_blink(frame):
+            pupil_list[frame_loc] = None
+            previous = None
+            if predictor is not None:
+                predictor.reset()
+            continue
+
+        if predictor is not None:
+            pupil_i = predictor.predict(frame)
+            if pupil_i is not None:
+                pupil_list[frame_loc] = pupil_i
+                previous = pupil_i
+                continue
+
+        if track and previous is not None:
+            try:
+                pupil_i = pupil.Pupil(frame, threshold, window=pupil.tracking_window(previous, frame.shape, scale=pre.PUPIL_TRACK_WINDOW), method=method)
+            except (pupil.EmptyAreas, pupil.PupilOutsideWindow):
+                pupil_i = None
+
+        if pupil_i is None:
+            try:
+                pupil_i = pupil.Pupil(frame, threshold, method=method, pyramid_levels=pyramid_levels)
+            except pupil.EmptyAreas:
+                if verbose:
+                    print('Pupil not found in frame: %d \n None type object used inplace' % frame_loc)
+
+        if predictor is not None:
+            predictor.update(frame, pupil_i)
+
+        if blink_filter is not None and pupil_i is not None:
+            blink_filter.update(frame, pupil_i)
+
+        pupil_list[frame_loc] = pupil_i
+        previous = pupil_i
+
+    if compact:
+        pupil_list.pack()
+
+    return pupil_list
+
+def empty_pupil_list(first_frame, last_frame, compact=False):
+    '''
+    Returns an empty dictionary, or an empty PupilTrack over the frame range if compact is True.
+    '''
+    if compact:
+        return trk.PupilTrack(first_frame, last_frame, contour_step=pre.PUPIL_CONTOUR_STEP)
+    return {}
+
+def _pupil_chunk(args):
+    '''
+    Construct the pupil list of an inclusive frame range. Executed in a worker process
+    with its own copy of the video.
+    '''
+    video, first, last, options = args
+    return construct_pupil_list(video, first, last, verbose=False, **options)
+
+def construct_pupil_list_parallel(video, first_frame, last_frame, workers=None, chunk_size=None, **options):
+    '''
+    Construct a dictionary of pupil objects for a series of video frames in parallel
+    worker processes. The range is split into contiguous chunks, every chunk is read
+    and analyzed by a worker with its own capture handle, and the chunks are merged in
+    frame order. At most two chunks per worker are processed ahead of the merge.
+
+    Inputs:
+        video - Video (or any picklable video-like) object
+        first_frame - Integer representing index of first frame to analyze.
+        last_frame - Integer representing index of last frame to analyze.
+        workers - number of worker processes, by default the number of cores
+        chunk_size - number of frames per chunk, by default the range is split into
+                four chunks per worker
+        options - threshold, track, batch_size, method, pyramid_levels and compact,
+                see construct_pupil_list
+
+    Outputs:
+        pupil_list: Dictionary of pupil objects where the key is the frame number and the value is the pupil object.
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    chunks = vid.split_range(first_frame, last_frame, num_chunks=4 * workers, chunk_size=chunk_size)
+
+    pupil_list = empty_pupil_list(first_frame, last_frame, options.get('compact', False))
+
+    def merge(chunk, result):
+        missing = [frame_loc for frame_loc, pupil_i in result.items() if pupil_i is None]
+        if missing:
+            print('Pupil not found in %d of the frames %d-%d \n None type objects used inplace' % (len(missing), chunk[0], chunk[1]))
+        pupil_list.update(result)
+
+    with multiprocessing.Pool(workers) as pool:
+        pending = []
+        for chunk in tqdm(chunks):
+            pending.append((chunk, pool.apply_async(_pupil_chunk, ((video,) + chunk + (options,),))))
+            if len(pending) >= 2 * workers:
+                chunk, result = pending.pop(0)
+                merge(chunk, result.get())
+        for chunk, result in pending:
+            merge(chunk, result.get())
+
+    if options.get('compact', False):
+        pupil_list.pack()
+
+    return pupil_list
+
+def construct_pupil_list_threaded(video, first_frame, last_frame, executor, threshold=10, method='ellipse', pyramid_levels=0, compact=False,
+                                  verbose=True):
+    '''
+    Construct a dictionary of pupil objects for a series of video frames, detecting the
+    pupils in the threads of a StageExecutor. The executor reports the utilization of
+    the 'pupil' stage.
+
+    Inputs:
+        video - video object
+        first_frame - Integer representing index of first frame to analyze.
+        last_frame - Integer representing index of last frame to analyze.
+        executor - StageExecutor object
+        threshold, method, pyramid_levels, compact - see construct_pupil_list
+        verbose - if True, print the number of frames without a pupil
+
+    Outputs:
+        pupil_list: Dictionary of pupil objects where the key is the frame number and the value is the pupil object.
+    '''
+    def detect(frame_loc, frame):
         try:
-            pupil_i = pupil.Pupil(frame, threshold)
+            return pupil.Pupil(frame, threshold, method=method, pyramid_levels=pyramid_levels)
         except pupil.EmptyAreas:
-            print('Pupil not found in frame: %d \n None type object used inplace' % frame_loc)
-            pupil_list[frame_loc] = None
-        else:
-            pupil_list[frame_loc] = pupil_i
+            return None
+
+    pupil_list = empty_pupil_list(first_frame, last_frame, compact)
+
+    for frame_loc, pupil_i in tqdm(executor.run(video, first_frame, last_frame, [('pupil', detect)])):
+        pupil_list[frame_loc] = pupil_i
+
+    missing = sum(1 for frame_loc in pupil_list if pupil_list.get(frame_loc) is None)
+    if missing and verbose:
+        print('Pupil not found in %d of the frames %d-%d \n None type objects used inplace' % (missing, first_frame, last_frame))
+
+    if compact:
+        pupil_list.pack()
+
+    return pupil_list
+
+def construct_pupil_list_batch(video, first_frame, last_frame, threshold=10, batch_size=256, method='ellipse', compact=False, verbose=True):
+    '''
+    Construct a dictionary of pupil objects for a series of video frames, reading
+    and thresholding the frames in stacks of batch_size frames.
+
+    Inputs:
+        video - video object
+        first_frame - Integer representing index of first frame to analyze.
+        last_frame - Integer representing index of last frame to analyze.
+        threshold - pupil detection threshold
+        batch_size - number of frames processed at once
+        method - pupil estimator, 'ellipse' or 'moments', see pupil.detect_pupils
+        compact - if True, return a PupilTrack, see construct_pupil_list
+        verbose - if True, print a message for every frame without a pupil
+
+    Outputs:
+        pupil_list: Dictionary of pupil objects where the key is the frame number and the value is the pupil object.
+    '''
+    pupil_list = empty_pupil_list(first_frame, last_frame, compact)
+
+    for first, last in tqdm(vid.split_range(first_frame, last_frame, chunk_size=batch_size)):
+        frames = video.read_batch(first, last + 1)
+        # blobs of the 'moments' method, the contours are only extracted when read
+        properties = pupil.detect_pupils(frames, threshold, return_contours=True, method=method, return_blobs=True)
+
+        for j, (col, row, radius, major, minor, angle, contour) in enumerate(zip(*properties)):
+            frame_loc = first + j
+            if contour is None:
+                if verbose:
+                    print('Pupil not found in frame: %d \n None type object used inplace' % frame_loc)
+                pupil_list[frame_loc] = None
+            elif method == 'moments':
+                pupil_list[frame_loc] = pupil.pupil_from_properties(col, row, radius, major, minor, angle, blob=contour)
+            else:
+                pupil_list[frame_loc] = pupil.pupil_from_properties(col, row, radius, major, minor, angle, contour)
+
+    if compact:
+        pupil_list.pack()
 
     return pupil_list
+
+def sweep_thresholds(video, first_frame, last_frame, thresholds=pre.PUPIL_SWEEP_THRESHOLDS, step=1, method='ellipse'):
+    '''
+    Evaluate several pupil detection thresholds on the same frames. Every frame is
+    decoded once and the pupil is detected with each threshold on it.
+
+    Inputs:
+        video - video object
+        first_frame - Integer representing index of first frame to analyze.
+        last_frame - Integer representing index of last frame to analyze.
+        thresholds - list of pupil detection thresholds
+        step - only every step-th frame of the range is analyzed
+        method - pupil estimator, 'ellipse' or 'moments', see pupil.Pupil
+
+    Outputs:
+        sweep - Dictionary where the key is the threshold and the value is a dictionary
+                'detection_rate' : fraction of the frames in which a pupil was found
+                'area_cv' : coefficient of variation of the pupil ellipse area over the
+                            frames with a pupil, low values indicate a stable detection
+                'residual' : mean distance in pixels between the pupil contours and their
+                             fitted ellipses, see pupil.fit_residual
+    '''
+    areas = {threshold: [] for threshold in thresholds}
+    residuals = {threshold: [] for threshold in thresholds}
+    num_frames = 0
+
+    for frame in tqdm(video[first_frame:last_frame+1:step]):
+        num_frames += 1
+        for threshold in thresholds:
+            try:
+                pupil_i = pupil.Pupil(frame, threshold, method=method)
+            except (pupil.EmptyAreas, cv2.error):
+                # low thresholds can leave only tiny blobs, an ellipse needs at least 5 points
+                continue
+            areas[threshold].append(np.pi/4 * pupil_i.major * pupil_i.minor)
+            residuals[threshold].append(pupil.fit_residual(pupil_i))
+
+    sweep = {}
+    for threshold in thresholds:
+        area = np.array(areas[threshold])
+        sweep[threshold] = {'detection_rate': len(area)/num_frames if num_frames else 0.0,
+                            'area_cv': float(np.std(area)/np.mean(area)) if len(area) and np.mean(area) > 0 else np.nan,
+                            'residual': float(np.nanmean(residuals[threshold])) if len(area) and not np.all(np.isnan(residuals[threshold])) else np.nan}
+
+    return sweep
+
+def recommend_threshold(sweep, min_detection=pre.PUPIL_SWEEP_MIN_DETECTION):
+    '''
+    Recommend a pupil detection threshold from the results of sweep_thresholds.
+
+    Among the thresholds whose detection rate is at least min_detection times the
+    best detection rate, the threshold with the most stable pupil area is chosen. Ties
+    are broken by the lower fit residual.
+
+    Outputs:
+        threshold - recommended threshold, or None if no pupil was detected
+    '''
+    best_rate = max([result['detection_rate'] for result in sweep.values()] + [0])
+    if best_rate == 0:
+        return None
+
+    def key(threshold):
+        result = sweep[threshold]
+        area_cv = result['area_cv'] if np.isfinite(result['area_cv']) else np.inf
+        residual = result['residual'] if np.isfinite(result['residual']) else np.inf
+        return (area_cv, residual)
+
+    candidates = [threshold for threshold, result in sweep.items() if result['detection_rate'] >= min_detection * best_rate]
+    return min(candidates, key=key)
+
+def estimate_roi(video, first_frame, last_frame, threshold=10, num_samples=10, margin=pre.ROI_MARGIN):
+    '''
+    Estimate the region of the frame containing the eye from the pupil positions in
+    a sample of equally spaced frames. The region bounds the sampled pupils and is
+    extended by margin pixels on every side to leave room for the iris and eyelids.
+
+    Inputs:
+        video - video object
+        first_frame - Integer representing index of first frame to sample.
+        last_frame - Integer representing index of last frame to sample.
+        threshold - pupil detection threshold
+        num_samples - number of frames to sample
+        margin - number of pixels added around the sampled pupils
+
+    Outputs:
+        roi - (top, bottom, left, right) pixel bounds in full frame coordinates, or
+              None if no pupil was found in the sampled frames.
+    '''
+    # sample full frames, the current region may not contain the whole eye
+    previous_roi = video.roi
+    video.set_roi(None)
+
+    rows = []
+    cols = []
+    try:
+        last_frame = min(last_frame, len(video) - 1)
+        for frame_loc in np.unique(np.linspace(first_frame, last_frame, num_samples, dtype=int)):
+            try:
+                pupil_i = pupil.Pupil(video[frame_loc], threshold)
+            except pupil.EmptyAreas:
+                continue
+            extent = pupil_i.major/2
+            rows += [pupil_i.center_row - extent, pupil_i.center_row + extent]
+            cols += [pupil_i.center_col - extent, pupil_i.center_col + extent]
+    finally:
+        video.set_roi(previous_roi)
+
+    if not rows:
+        return None
+
+    return vid.clip_roi((min(rows) - margin, max(rows) + margin, min(cols) - margin, max(cols) + margin),
+                        video.height, video.width)
@@ -0,0 +1,112 @@
+'''
+Thread pool execution of per-frame processing stages.
+
+Most of the per-frame work (thresholding and contours in Pupil, Canny and HoughLines
+in eyelid.detect_eyelid, remap in iris.iris_transform) runs inside OpenCV, which
+releases the GIL. Running these stages in threads avoids pickling the frames and
+results between processes, which dominates when the per-frame data is large.
+'''
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import multiprocessing
+import time
+
+class StageExecutor:
+    '''
+    Run a sequence of stages on every frame of a range in a pool of threads.
+
+    Frames are decoded in order on the calling thread, every frame is passed through
+    the stages by a worker thread, and the results are returned in frame order. At
+    most max_in_flight frames are decoded ahead of the consumer.
+    '''
+
+    def __init__(self, workers=None, max_in_flight=None):
+        '''
+        Inputs:
+            workers - number of worker threads, by default the number of cores
+            max_in_flight - maximum number of frames being processed or waiting to be
+                consumed, by default two per worker
+
+        Attributes:
+            busy - dictionary of the total time spent in each stage, by stage name
+            read_time - total time spent decoding frames
+            elapsed - total wall time of the runs
+        '''
+        self.workers = workers or multiprocessing.cpu_count()
+        self.max_in_flight = max_in_flight or 2 * self.workers
+
+        self.busy = OrderedDict()
+        self.read_time = 0.0
+        self.elapsed = 0.0
+
+    def run(self, video, first_frame, last_frame, stages):
+        '''
+        Process the frames [first_frame, last_frame] of a video.
+
+        Inputs:
+            video - video object
+            first_frame - index of the first frame
+            last_frame - index of the last frame (inclusive)
+            stages - list of (name, function) pairs. The first function is called with
+                the frame number and the frame, every following function with the frame
+                number and the result of the previous stage.
+
+        Outputs:
+            results - generator of (frame number, result of the last stage) in frame order
+        '''
+        for name, function in stages:
+            self.busy.setdefault(name, 0.0)
+
+        def process(frame_loc, value):
+            timings = []
+            for name, function in stages:
+                start = time.perf_counter()
+                value = function(frame_loc, value)
+                timings.append((name, time.perf_counter() - start))
+            return value, timings
+
+        start = time.perf_counter()
+        pending = []
+
+        def collect():
+            frame_loc, future = pending.pop(0)
+            value, timings = future.result()
+            for name, duration in timings:
+                self.busy[name] += duration
+            return frame_loc, value
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            try:
+                frames = iter(video[first_frame:last_frame+1])
+                for frame_loc in range(first_frame, last_frame + 1):
+                    read_start = time.perf_counter()
+                    frame = next(frames, None)
+                    self.read_time += time.perf_counter() - read_start
+                    if frame is None:
+                        break
+
+                    pending.append((frame_loc, pool.submit(process, frame_loc, frame)))
+                    if len(pending) >= self.max_in_flight:
+                        yield collect()
+
+                while pending:
+                    yield collect()
+            finally:
+                # stopped early, drop the frames that were not started
+                for frame_loc, future in pending:
+                    future.cancel()
+                self.elapsed += time.perf_counter() - start
+
+    def utilization(self):
+        '''
+        Returns a dictionary of the fraction of the available worker time spent in each
+        stage, by stage name, and the fraction of the wall time spent decoding frames
+        on the calling thread, 'read'.
+        '''
+        if not self.elapsed:
+            return {}
+
+        utilization = OrderedDict([('read', self.read_time / self.elapsed)])
+        for name, busy in self.busy.items():
+            utilization[name] = busy / (self.elapsed * self.workers)
+        return utilization
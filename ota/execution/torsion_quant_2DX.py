@@ -175,15 +175,19 @@ def quantify_torsion(
 
     # get the reference window from the first frame of the video
     # this will be the base for all torsion ie. all rotation is relative to this window
-    ref_pupil = pupil.Pupil(video[reference_frame], threshold)
+    reference_image = video[reference_frame]
+    # use the pupil of the list, found with the same estimator as the other frames
+    ref_pupil = pupil_list.get(reference_frame)
+    if ref_pupil is None:
+        ref_pupil = pupil.Pupil(reference_image, threshold)
     if transform_mode == 'alternate':
-        first_window_sr = iris.iris_transform(video[reference_frame],
+        first_window_sr = iris.iris_transform(reference_image,
             ref_pupil,
             WINDOW_RADIUS,
             theta_resolution=upsample_factor,
             theta_window=reference_bounds_sr)
 
-    first_window = iris.iris_transform(video[reference_frame],
+    first_window = iris.iris_transform(reference_image,
         ref_pupil,
         WINDOW_RADIUS,
         theta_resolution = upsample_factor,
@@ -198,7 +202,7 @@ def quantify_torsion(
 
     if noise_replace:
         # replace occluded sections with noise
-        first_window = iris.iris_transform(mask_img(eyelid_list[reference_frame], video[reference_frame]),
+        first_window = iris.iris_transform(mask_img(eyelid_list[reference_frame], reference_image),
                                            ref_pupil,
                                            WINDOW_RADIUS,
                                            theta_resolution=upsample_factor,
@@ -207,7 +211,7 @@ def quantify_torsion(
         # Find mean iris intensity
         normalized_magnitude = calculate_iris_mean(first_window)
         # replace occluded sections with noise
-        first_window = iris.iris_transform(mask_img(eyelid_list[reference_frame], video[reference_frame], normalized_magnitude=normalized_magnitude),
+        first_window = iris.iris_transform(mask_img(eyelid_list[reference_frame], reference_image, normalized_magnitude=normalized_magnitude),
                                            ref_pupil,
                                            WINDOW_RADIUS,
                                            theta_resolution=upsample_factor,
@@ -327,9 +331,13 @@ def quantify_torsion(
 
 def mask_img(mask, frame, normalized_magnitude=None):
     '''
-    Bitwise masking of a frame with a given mask
+    Bitwise masking of a frame with a given mask. The mask is either an image with the
+    eyelids removed or an eyelid.Eyelid, which is rasterized on the frame.
     '''
-    maskedImg = cv2.bitwise_and(frame, mask)
+    if isinstance(mask, np.ndarray):
+        maskedImg = cv2.bitwise_and(frame, mask)
+    else:
+        maskedImg = mask.apply(frame)
     if normalized_magnitude:
         maskedImg[maskedImg == 0] = normalized_magnitude
     return maskedImg
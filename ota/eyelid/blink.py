@@ -0,0 +1,132 @@
+import numpy as np
+import cv2
+from math import sqrt
+
+from ota import presets as pre
+
+class BlinkFilter:
+    """
+    Cheap blink pre-filter, used to skip the pupil and eyelid detection in frames where
+    the eye is likely closed.
+
+    A frame is flagged as a blink from two statistics measured around the last pupil
+    found in an open eye: the fraction of dark pixels inside the pupil, which drops when
+    the lid covers it, and the mean intensity over the iris, which jumps when the lid
+    (brighter than the iris) moves over it.
+
+    If the pupil moved during a blink, the regions of the last pupil no longer cover it
+    and every following frame would be flagged. Every reacquire_interval-th consecutive
+    flagged frame is therefore let through, so that the pupil is detected again and
+    given to update. Callers that already know the pupil of a frame pass it to is_blink
+    to measure the statistics around it.
+    """
+
+    def __init__(self, threshold=10, min_dark_fraction=pre.BLINK_MIN_DARK_FRACTION,
+                 max_intensity_jump=pre.BLINK_MAX_INTENSITY_JUMP, iris_scale=pre.BLINK_IRIS_SCALE,
+                 reacquire_interval=pre.BLINK_REACQUIRE_INTERVAL):
+        """
+        Parameters
+        ------------------------
+        threshold : int
+            Pupil detection threshold, pixels at or below it are dark
+        min_dark_fraction : float
+            Smallest fraction of dark pixels inside the last pupil for an open eye
+        max_intensity_jump : float
+            Largest change of the mean intensity over the iris for an open eye
+        iris_scale : float
+            Half size of the iris region as a multiple of the pupil radius
+        reacquire_interval : int
+            Number of consecutive flagged frames after which a frame is not flagged,
+            so that the caller detects the pupil again
+
+        Attributes
+        ------------------------
+        checked : int
+            Number of frames tested
+        flagged : int
+            Number of frames flagged as blinks
+        reacquired : int
+            Number of blink frames let through to find the pupil again
+        """
+        self.threshold = threshold
+        self.min_dark_fraction = min_dark_fraction
+        self.max_intensity_jump = max_intensity_jump
+        self.iris_scale = iris_scale
+        self.reacquire_interval = reacquire_interval
+
+        self.checked = 0
+        self.flagged = 0
+        self.reacquired = 0
+
+        # number of consecutive frames found to be blinks
+        self.run = 0
+
+        self.pupil_box = None
+        self.iris_box = None
+        self.iris_mean = None
+
+    def __box(self, pupil, half, shape):
+        row = int(pupil.center_row)
+        col = int(pupil.center_col)
+        half = max(1, int(half))
+        return (max(0, row - half), min(shape[0], row + half + 1),
+                max(0, col - half), min(shape[1], col + half + 1))
+
+    def update(self, frame, pupil):
+        """
+        Take the regions and reference statistics from a pupil found in an open eye.
+        """
+        self.pupil_box, self.iris_box = self.__regions(frame, pupil)
+
+        top, bottom, left, right = self.iris_box
+        self.iris_mean = cv2.mean(frame[top:bottom, left:right])[0]
+        self.run = 0
+
+    def __regions(self, frame, pupil):
+        # square inscribed in the pupil, and a square covering the iris
+        return (self.__box(pupil, pupil.minor/(2*sqrt(2)), frame.shape),
+                self.__box(pupil, self.iris_scale*pupil.radius, frame.shape))
+
+    def is_blink(self, frame, pupil=None):
+        """
+        Returns True if the frame is likely a blink. Frames are never flagged before a
+        pupil was given to update.
+
+        Parameters
+        ------------------------
+        frame : array_like
+            Grayscale video frame
+        pupil : Pupil
+            Pupil of the frame if it is already known. The statistics are measured
+            around it instead of around the last pupil given to update.
+        """
+        if self.pupil_box is None:
+            return False
+        self.checked += 1
+
+        pupil_box, iris_box = (self.pupil_box, self.iris_box) if pupil is None else self.__regions(frame, pupil)
+
+        top, bottom, left, right = pupil_box
+        dark_fraction = np.count_nonzero(frame[top:bottom, left:right] <= self.threshold) / max(1, (bottom - top)*(right - left))
+
+        top, bottom, left, right = iris_box
+        jump = abs(cv2.mean(frame[top:bottom, left:right])[0] - self.iris_mean)
+
+        if dark_fraction >= self.min_dark_fraction and jump <= self.max_intensity_jump:
+            self.run = 0
+            return False
+
+        # let a frame through now and then to find a pupil that moved during the blink
+        self.run += 1
+        if self.run % self.reacquire_interval == 0:
+            self.reacquired += 1
+            return False
+
+        self.flagged += 1
+        return True
+
+    def statistics(self):
+        """
+        Returns a dictionary of the number of tested, flagged and reacquired frames.
+        """
+        return {'checked': self.checked, 'flagged': self.flagged, 'reacquired': self.reacquired}
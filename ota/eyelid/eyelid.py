@@ -11,11 +11,152 @@ import numpy as np
 from ota.video import video as vid
 from ota import presets
 from ota.pupil import pupil
+from ota.pupil import track as trk
 from ota.iris import iris
 
 
 from functools import reduce
 
+class Eyelid:
+    """
+    Parametric representation of the upper and lower eyelids within a video image.
+
+    The eyelids are polynomials of the column giving the row of the lid. Masks of the
+    image regions covered by the eyelids are only rasterized when needed.
+    """
+
+    __slots__ = ('upper', 'lower', 'upper_translation', 'lower_translation', 'shape')
+
+    def __init__(self, upper, lower, upper_translation=0, lower_translation=0, shape=None):
+        """
+        Parameters
+        ------------------------
+        upper : array_like
+            Coefficients of the polynomial fitted to the upper lid, highest degree first
+        lower : array_like
+            Coefficients of the polynomial fitted to the lower lid, highest degree first
+        upper_translation : float
+            Amount by which the upper lid is translated down
+        lower_translation : float
+            Amount by which the lower lid is translated up
+        shape : tuple
+            (rows, columns) of the image the eyelids were detected in
+        """
+        self.upper = np.asarray(upper, dtype=np.float64)
+        self.lower = np.asarray(lower, dtype=np.float64)
+        self.upper_translation = upper_translation
+        self.lower_translation = lower_translation
+        self.shape = None if shape is None else tuple(shape[:2])
+
+    def params(self):
+        """
+        Returns the (2, POLY_DEG+1) array of the translated upper and lower lid coefficients.
+        """
+        upper = self.upper.copy()
+        lower = self.lower.copy()
+        upper[-1] += self.upper_translation
+        lower[-1] -= self.lower_translation
+        return np.array([upper, lower])
+
+    def lids(self, width=None):
+        """
+        Returns the integer rows of the translated upper and lower lids at every column.
+        """
+        X = np.arange(0, self.shape[1] if width is None else width, 1)
+        upper, lower = self.params()
+        return np.array(np.poly1d(upper)(X), dtype='int'), np.array(np.poly1d(lower)(X), dtype='int')
+
+    def __bounds(self, shape):
+        # rows [0, upper) and [lower_start, lower_stop) of every column are covered by
+        # the eyelids. Matches the slicing of the original masked copy of the image, in
+        # which the lower lid slice ends at the image width.
+        rows, cols = shape[:2]
+        ulid, llid = self.lids(cols)
+        upper = np.where(ulid >= 0, ulid, 0)
+        lower_start = np.where(llid >= 0, llid, np.maximum(rows + llid, 0))
+        lower_stop = np.where(llid <= cols, min(rows, cols), 0)
+        return upper, lower_start, lower_stop
+
+    def mask(self, shape=None):
+        """
+        Rasterize the eyelids.
+
+        Returns
+        ------------------------
+        mask : array_like
+            Boolean array of the given (or detection) image shape, True above the upper
+            lid and below the lower lid
+        """
+        shape = self.shape if shape is None else shape
+        upper, lower_start, lower_stop = self.__bounds(shape)
+        rows = np.arange(shape[0])[:, np.newaxis]
+        return (rows < upper) | ((rows >= lower_start) & (rows < lower_stop))
+
+    def covers(self, rows, cols):
+        """
+        Returns a boolean array, True for the (rows, cols) pixels covered by the eyelids.
+        The coordinates are clipped to the image.
+        """
+        upper, lower_start, lower_stop = self.__bounds(self.shape)
+        rows = np.clip(rows, 0, self.shape[0] - 1)
+        cols = np.clip(cols, 0, self.shape[1] - 1)
+        return (rows < upper[cols]) | ((rows >= lower_start[cols]) & (rows < lower_stop[cols]))
+
+    def empty(self):
+        """
+        Returns True if the eyelids do not cover any pixel of the image.
+        """
+        upper, lower_start, lower_stop = self.__bounds(self.shape)
+        return not ((upper > 0).any() or (lower_stop > lower_start).any())
+
+    def apply(self, image):
+        """
+        Returns a copy of the image with the parts above the upper eyelid and below the
+        lower eyelid blocked out.
+        """
+        eyelids_removed = image.copy()
+        eyelids_removed[self.mask(image.shape)] = 0
+        return eyelids_removed
+
+def interpolate_eyelid(start, end, weight):
+    """
+    Linear interpolation between two eyelids, weight 0 gives start and 1 gives end.
+    Interpolating the polynomial coefficients interpolates the lid rows at every column.
+    """
+    return Eyelid((1 - weight)*start.upper + weight*end.upper,
+                  (1 - weight)*start.lower + weight*end.lower,
+                  (1 - weight)*start.upper_translation + weight*end.upper_translation,
+                  (1 - weight)*start.lower_translation + weight*end.lower_translation,
+                  start.shape)
+
+def eyelid_params(eyelid_list, frames):
+    """
+    Stack the translated lid coefficients of a series of frames, see pupil_obstruct_batch.
+
+    Parameters
+    ------------------------
+    eyelid_list : dictionary
+        Dictionary of Eyelid objects where the key is the frame number
+    frames : iterable
+        Frame numbers in order
+
+    Returns
+    ------------------------
+    params : array_like
+        (N, 2, POLY_DEG+1) array, NaN for frames without eyelids
+    """
+    params = [None if eyelid_list.get(frame_loc) is None else eyelid_list[frame_loc].params() for frame_loc in frames]
+    known = [p for p in params if p is not None]
+    if not known:
+        return np.full((len(params), 2, 1), np.nan)
+
+    nan = np.full_like(known[0], np.nan)
+    return np.array([nan if p is None else p for p in params])
+
+class EyelidNotFound(Exception):
+    def __init__(self):
+        Exception.__init__(self,'No eyelid edge found on one of the sides of the pupil, the eye might be closed.')
+
 def detect_eyelid(image, pupil, **kw):
     """
     Detect the upper and lower eyelids within a video image
@@ -29,8 +170,10 @@ def detect_eyelid(image, pupil, **kw):
 
     Returns
     ------------------------
-    eyelids_removed : array_like
-        A video image with the parts above the upper eyelid and below the lower eyelid blocked out.
+    eyelid : Eyelid
+        The upper and lower lid polynomials and their translations. Eyelid.apply(image)
+        gives the video image with the parts above the upper eyelid and below the lower
+        eyelid blocked out.
     """
 
     # Define parameters to be used in eyelid detection
@@ -148,29 +291,105 @@ def detect_eyelid(image, pupil, **kw):
     llid_y = np.append(ll_y, lr_y)
 
     # Fit a polynomial to the upper and lower lids individually
-    X = np.arange(0, image.shape[1], 1)
-
-    z = np.polyfit(ulid_x, ulid_y, POLY_DEG)
-    z[POLY_DEG] = z[POLY_DEG] + UPPER_LID_POLY_TRANS # Translate the estimated eyelid down.
-    ulid_poly = np.poly1d(z)
-    ulid = np.array(ulid_poly(X), dtype='int')
+    ulid_z = np.polyfit(ulid_x, ulid_y, POLY_DEG)
+    llid_z = np.polyfit(llid_x, llid_y, POLY_DEG)
 
-    z = np.polyfit(llid_x, llid_y, POLY_DEG)
-    z[POLY_DEG] = z[POLY_DEG] - LOWER_LID_POLY_TRANS# Translate the estimated eyelid up.
-    llid_poly = np.poly1d(z)
-    llid = np.array(llid_poly(X), dtype='int')
+    # The estimated upper eyelid is translated down and the lower eyelid up
+    return Eyelid(ulid_z, llid_z, UPPER_LID_POLY_TRANS, LOWER_LID_POLY_TRANS, image.shape)
 
-    eyelids_removed = image.copy()
+def detect_eyelid_fast(image, pupil, **kw):
+    """
+    Detect the upper and lower eyelids within a video image, faster variant of
+    detect_eyelid taking the same parameters.
+
+    Canny edge detection is run only over the four strips beside the pupil, above and
+    below it, leaving out the pupil columns. In each strip the strongest line with a
+    normal angle in [min_theta, max_theta] is found with a Hough transform requiring
+    HOUGH_THRESHOLD votes. The points of the lines of both sides are fitted with a
+    polynomial in a single vectorized pass, as in detect_eyelid.
+
+    The angle limited Hough transform is kept over a least squares or RANSAC line fit
+    of the strip edge points: the fits are not faster on clean edge maps, where the
+    Hough transform only has a few hundred points to vote, and on noisy frames the
+    edge points of the noise pull them tens of pixels away from the lid. It is also
+    kept over the probabilistic cv2.HoughLinesP, which has no angle limits: its
+    segments have to be filtered by slope afterwards, it is about 1.5 times slower
+    on clean strips and 3 times slower on noisy ones, and on noisy strips the longest
+    remaining segment is at times a noise segment over a hundred pixels off the lid.
 
-    # for each index value in ulid and llid
-    for i in range(len(ulid)):
-        # set the parts of the image above and below the eyelid to 0
-        if ulid[i] >= 0:
-            eyelids_removed[0:ulid[i],i] = 0
-        if llid[i] <= image.shape[1]:
-            eyelids_removed[llid[i]:image.shape[1],i] = 0
+    Parameters
+    ------------------------
+    image : array_like
+        Grayscale video image containing eyelid to be detected
+    pupil: pupil object
+        Object representing the pupil within the given image
+    kw :
+        Parameters of detect_eyelid, and
+        HOUGH_THRESHOLD - minimum number of votes of a line
 
-    return eyelids_removed
+    Returns
+    ------------------------
+    eyelid : Eyelid
+        The upper and lower lid polynomials and their translations, see detect_eyelid.
+        Raises EyelidNotFound if no line is found on either side of a lid.
+    """
+    ROI_STRIP_WIDTH = kw.get('ROI_STRIP_WIDTH', 200)
+    ROI_BUFFER = kw.get('ROI_BUFFER', 20)
+    LOWER_CANNY = kw.get('LOWER_CANNY', 50)
+    UPPER_CANNY = kw.get('UPPER_CANNY', 60)
+    min_theta = kw.get('min_theta', 70 * np.pi/180)
+    max_theta = kw.get('max_theta', 110 * np.pi/180)
+    POLY_DEG = kw.get('POLY_DEG', 2)
+    UPPER_LID_POLY_TRANS = kw.get('UPPER_LID_POLY_TRANS', 40)
+    LOWER_LID_POLY_TRANS = kw.get('LOWER_LID_POLY_TRANS', 20)
+    HOUGH_THRESHOLD = kw.get('HOUGH_THRESHOLD', 20)
+
+    rows, cols = image.shape[:2]
+
+    # Columns of the side strips, clipped to the image
+    l_cols = (max(0, int(pupil.center_col - (pupil.radius + ROI_STRIP_WIDTH))), max(0, int(pupil.center_col - (pupil.radius + ROI_BUFFER))))
+    r_cols = (min(cols, int(pupil.center_col + (pupil.radius + ROI_BUFFER))), min(cols, int(pupil.center_col + (pupil.radius + ROI_STRIP_WIDTH))))
+
+    u_rows = (0, max(0, int(pupil.center_row - ROI_BUFFER)))
+    l_rows = (min(rows, int(pupil.center_row + ROI_BUFFER)), rows)
+
+    def lid_points(band_rows):
+        xs = []
+        ys = []
+        for side in (l_cols, r_cols):
+            roi = image[band_rows[0]:band_rows[1], side[0]:side[1]]
+            if roi.size == 0:
+                raise EyelidNotFound
+
+            strip = cv2.Canny(roi, LOWER_CANNY, UPPER_CANNY)
+            lines = cv2.HoughLines(strip, 1, np.pi/180, HOUGH_THRESHOLD, min_theta=min_theta, max_theta=max_theta)
+            if lines is None:
+                raise EyelidNotFound
+
+            # Points of the strongest line across the strip, every 10 columns
+            rho, theta = lines[0][0]
+            X = np.arange(0, strip.shape[1], 10)
+            Y = (rho - X*np.cos(theta))/np.sin(theta)
+            inside = (Y >= 0) & (Y <= strip.shape[0] - 1)
+            xs.append(X[inside] + side[0])
+            ys.append(np.array(Y[inside], dtype='int') + band_rows[0])
+
+        xs = np.concatenate(xs)
+        ys = np.concatenate(ys)
+        if len(xs) <= POLY_DEG:
+            raise EyelidNotFound
+        return xs, ys
+
+    ulid_x, ulid_y = lid_points(u_rows)
+    llid_x, llid_y = lid_points(l_rows)
+
+    ulid_z = np.polyfit(ulid_x, ulid_y, POLY_DEG)
+    llid_z = np.polyfit(llid_x, llid_y, POLY_DEG)
+
+    return Eyelid(ulid_z, llid_z, UPPER_LID_POLY_TRANS, LOWER_LID_POLY_TRANS, image.shape)
+
+# Eyelid detectors selectable by name
+DETECTORS = {'hough': detect_eyelid, 'fast': detect_eyelid_fast}
 
 def pupil_obstruct(eyelid_mat, contour):
     """
@@ -178,9 +397,9 @@ def pupil_obstruct(eyelid_mat, contour):
 
     Parameters
     ------------------------
-    eyelid_mat : array_like
-        An image with the eyelids removed
-        
+    eyelid_mat : Eyelid or array_like
+        The eyelids, or an image with the eyelids removed
+
     contour: array_like
         The contour of the pupil of the eye.
 
@@ -193,20 +412,81 @@ def pupil_obstruct(eyelid_mat, contour):
     if eyelid_mat is None or contour is None:
         return None
 
-     # Find locations where eyelid exists
-    indices_zero = np.nonzero(eyelid_mat == 0)
+    # Contour points are (col, row)
+    points = np.asarray(contour).reshape(-1, 2)
+
+    if isinstance(eyelid_mat, Eyelid):
+        # If there is no eyelid, just abort
+        if eyelid_mat.empty():
+            return True
+        # Evaluate the lids at the contour points, without rasterizing them
+        covered = eyelid_mat.covers(points[:, 1], points[:, 0])
+    else:
+        # Find locations where eyelid exists
+        eyelid_mask = eyelid_mat == 0
+
+        # If there is no eyelid, just abort
+        if not eyelid_mask.any():
+            return True
+
+        # Look the contour points up in the mask
+        rows = np.clip(points[:, 1], 0, eyelid_mask.shape[0] - 1)
+        cols = np.clip(points[:, 0], 0, eyelid_mask.shape[1] - 1)
+        covered = eyelid_mask[rows, cols]
+
+    # The pupil is obstructed if any point of its contour lies on the eyelid
+    if covered.any():
+        return 1
+    return 0
+
+def pupil_obstruct_batch(pupil_list, eyelid_params):
+    """
+    Determine if the pupil is obstructed in every frame of a pupil track, from the
+    eyelid polynomials of the frames instead of masked images.
+
+    A contour point (col, row) lies on the eyelid if row < int(ulid(col)) or
+    row >= int(llid(col)), where ulid and llid are the translated upper and lower lid
+    polynomials, which matches the pixels zeroed by detect_eyelid.
+
+    Parameters
+    ------------------------
+    pupil_list : PupilTrack
+        Pupil track (or dictionary of pupil objects) of the frames
+    eyelid_params : array_like
+        (N, 2, POLY_DEG+1) array of the upper and lower lid polynomial coefficients,
+        highest degree first, of the N frames of the track in order. The coefficients of
+        frames without eyelids are NaN. See eyelid_params.
+
+    Returns
+    ------------------------
+    blink_list : dictionary
+        key: frame number, value: 1 if the pupil is obstructed, 0 if not, None if the
+        frame has no pupil, contour or eyelids
+    """
+    if not isinstance(pupil_list, trk.PupilTrack):
+        pupil_list = trk.from_pupil_list(pupil_list)
+    pupil_list.pack()
+
+    eyelid_params = np.asarray(eyelid_params, dtype=np.float64)
+    lengths = np.diff(pupil_list.offsets)
+    known = pupil_list.valid() & (lengths > 0) & ~np.isnan(eyelid_params).any(axis=(1, 2))
+
+    # evaluate the lid polynomials of each contour point's frame at its column
+    frame_index = np.repeat(np.arange(len(pupil_list)), lengths)
+    points = pupil_list.points.reshape(-1, 2)
+    cols = points[:, 0].astype(np.float64)
+    rows = points[:, 1]
+
+    coefficients = eyelid_params[frame_index]
+    ulid = np.zeros(len(points))
+    llid = np.zeros(len(points))
+    for k in range(eyelid_params.shape[2]):
+        ulid = ulid*cols + coefficients[:, 0, k]
+        llid = llid*cols + coefficients[:, 1, k]
 
-     # If there is no eyelid, just abort
-    if indices_zero[0].size == 0 or indices_zero[1].size == 0:
-        return True
-    eyelid_locs = [(indices_zero[0][i], indices_zero[1][i]) for i in range(0, len(indices_zero))]
+    with np.errstate(invalid='ignore'):
+        obstructed = (rows < ulid.astype(int)) | (rows >= llid.astype(int))
 
-     # Get the contour into proper form: set of tuples (row, col)
-    contour = np.squeeze(contour)
-    contour = [tuple(x) for x in contour]
+    blinks = np.bincount(frame_index, weights=obstructed, minlength=len(pupil_list)) > 0
 
-     # Find the intersection between pupil contour and eyelid locations (intersection of 4 pixels)
-    intersection = np.array([x for x in contour if x in eyelid_locs])
-    if len(intersection) == 0:
-        return 0
-    return 1
+    return {frame_loc: (int(blinks[i]) if known[i] else None) for i, frame_loc in enumerate(pupil_list.keys())}
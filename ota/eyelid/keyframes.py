@@ -0,0 +1,175 @@
+import numpy as np
+
+from ota.eyelid import eyelid as lid
+from ota import presets as pre
+
+class EyelidKeyframes:
+    """
+    Keyframe mode of the eyelid identification.
+
+    The eyelids move slowly except during blinks, so the full eyelid detector is only run
+    every interval frames and the lid polynomials of the frames in between are linearly
+    interpolated between the surrounding keyframes. A frame is also made a keyframe when
+    a cheap intensity change test suggests that the lids moved: the pixels in a band
+    along the lids of the last keyframe are compared with the same pixels of the frame.
+
+    The frames between two keyframes are only interpolated when the lids did not move
+    between them: if the change test fails on the next keyframe, or its lids are more
+    than max_lid_shift pixels away from those of the last keyframe, the lids moved at an
+    unknown frame in between and the frames hold the lids of the last keyframe instead.
+    """
+
+    def __init__(self, detector, interval=pre.EYELID_KEYFRAME_INTERVAL, change_threshold=pre.EYELID_CHANGE_THRESHOLD,
+                 band=pre.EYELID_CHANGE_BAND, column_step=pre.EYELID_CHANGE_STEP, max_lid_shift=pre.EYELID_MAX_LID_SHIFT):
+        """
+        Parameters
+        ------------------------
+        detector : function
+            detector(frame, pupil) returns the Eyelid of a frame, or None if the eyelids
+            are not found
+        interval : int
+            Maximum number of frames between keyframes
+        change_threshold : float
+            Largest mean absolute difference of the pixel values along the lids for
+            which the lids are considered unmoved
+        band : int
+            Half height in pixels of the band sampled around each lid
+        column_step : int
+            Column spacing of the sampled pixels
+        max_lid_shift : float
+            Largest distance in pixels between the lids of two consecutive keyframes for
+            which the frames between them are interpolated
+
+        Attributes
+        ------------------------
+        full : int
+            Number of frames where the full eyelid detector was run
+        interpolated : int
+            Number of frames where the eyelids were interpolated
+        forced : int
+            Number of full detections caused by the intensity change test
+        """
+        self.detector = detector
+        self.interval = interval
+        self.change_threshold = change_threshold
+        self.band = band
+        self.column_step = column_step
+        self.max_lid_shift = max_lid_shift
+
+        self.full = 0
+        self.interpolated = 0
+        self.forced = 0
+
+        self.key = None
+        self.pending = []
+
+    def __samples(self, eyelid):
+        # pixel coordinates of the bands along the detected (not translated) lids
+        rows, cols = eyelid.shape
+        X = np.arange(0, cols, self.column_step)
+        offsets = np.arange(-self.band, self.band + 1)[:, np.newaxis]
+        lids = [np.poly1d(eyelid.upper)(X), np.poly1d(eyelid.lower)(X)]
+        r = np.concatenate([np.asarray(np.round(l), dtype=int) + offsets for l in lids], axis=1).ravel()
+        c = np.tile(X, 2*len(offsets))
+        inside = (r >= 0) & (r < rows)
+        return r[inside], c[inside]
+
+    def changed(self, frame):
+        """
+        Returns True if the pixels along the lids of the last keyframe changed in frame.
+        """
+        rows, cols, reference = self.key[2]
+        if not len(reference):
+            return True
+        return np.abs(frame[rows, cols].astype(np.float32) - reference).mean() > self.change_threshold
+
+    def __lid_shift(self, start, end):
+        # largest distance between the translated lids of two eyelids at the sampled columns
+        X = np.arange(0, start.shape[1], self.column_step)
+        return max(np.abs(np.poly1d(a)(X) - np.poly1d(b)(X)).max() for a, b in zip(start.params(), end.params()))
+
+    def __resolve(self, eyelid):
+        # eyelids of the frames since the last keyframe, interpolated up to eyelid, or
+        # holding the last keyframe when there is no next keyframe
+        resolved = []
+        start_loc, start = self.key[0], self.key[1]
+        for frame_loc in self.pending:
+            if eyelid is None:
+                resolved.append((frame_loc, start))
+            else:
+                resolved.append((frame_loc, lid.interpolate_eyelid(start, eyelid[1], (frame_loc - start_loc)/(eyelid[0] - start_loc))))
+        self.interpolated += len(self.pending)
+        self.pending = []
+        return resolved
+
+    def push(self, frame_loc, frame, pupil):
+        """
+        Add the next frame, in frame order.
+
+        Parameters
+        ------------------------
+        frame_loc : int
+            Frame number
+        frame : array_like
+            Grayscale video frame
+        pupil : Pupil
+            Pupil of the frame, or None
+
+        Returns
+        ------------------------
+        eyelids : list
+            (frame number, Eyelid or None) of the frames whose eyelids are now known
+        """
+        if not pupil:
+            resolved = self.flush()
+            return resolved + [(frame_loc, None)]
+
+        due = self.key is None or frame_loc - self.key[0] >= self.interval
+        moved = self.key is not None and self.changed(frame)
+        if not due:
+            if not moved:
+                self.pending.append(frame_loc)
+                return []
+            self.forced += 1
+
+        try:
+            eyelid = self.detector(frame, pupil)
+        except Exception:
+            eyelid = None
+        self.full += 1
+
+        if eyelid is None:
+            return self.flush() + [(frame_loc, None)]
+
+        resolved = []
+        if self.key is not None:
+            # the lids moved somewhere between the keyframes, hold the last keyframe
+            if moved or self.__lid_shift(self.key[1], eyelid) > self.max_lid_shift:
+                resolved = self.__resolve(None)
+            else:
+                resolved = self.__resolve((frame_loc, eyelid))
+
+        rows, cols = self.__samples(eyelid)
+        self.key = (frame_loc, eyelid, (rows, cols, frame[rows, cols].astype(np.float32)))
+
+        return resolved + [(frame_loc, eyelid)]
+
+    def flush(self):
+        """
+        Resolve the frames waiting for the next keyframe by holding the eyelids of the
+        last keyframe, and forget the last keyframe.
+
+        Returns
+        ------------------------
+        eyelids : list
+            (frame number, Eyelid) of the waiting frames
+        """
+        resolved = self.__resolve(None) if self.key is not None else []
+        self.key = None
+        return resolved
+
+    def statistics(self):
+        """
+        Returns a dictionary of the number of full and interpolated eyelid detections.
+        """
+        return {'full': self.full, 'interpolated': self.interpolated, 'forced': self.forced}
@@ -19,11 +19,15 @@ class FrameTracker(object):
 
     video : array_like
         series of video frames
+
+    jump : int
+        number of frames skipped by the left and right keys
     """
-    def __init__(self, ax, video):
+    def __init__(self, ax, video, jump=50):
         self.ax = ax
         self.ax.set_title('Use keyboard to navigate images')
         self.video = video
+        self.jump = jump
         self.slices = len(self.video)
         self.ind = 0
         self.im = ax.imshow(self.video[self.ind])
@@ -35,9 +39,9 @@ class FrameTracker(object):
         elif event.key =='down':
             self.ind = (self.ind - 1) % self.slices
         elif event.key =='right':
-            self.ind = (self.ind + 50) % self.slices
+            self.ind = (self.ind + self.jump) % self.slices
         elif event.key =='left':
-            self.ind = (self.ind - 50) % self.slices
+            self.ind = (self.ind - self.jump) % self.slices
         self.update()
 
     def update(self):
@@ -45,6 +49,45 @@ class FrameTracker(object):
         self.ax.set_xlabel('Frame %s' % self.ind)
         self.im.axes.figure.canvas.draw()
 
+class Thumbnails(object):
+    """
+    Lazy sequence of the downscaled frames of a video, indexed by frame number. Used
+    by the preview_scroll method.
+
+    Thumbnails are decoded when they are first shown and kept. Consecutive jumps of
+    step frames continue one decimated pass through the video (see Video.decimate),
+    so paging through the video with a constant stride reuses the decoder position.
+
+    Parameters
+    ------------------------
+    video : Video object
+        video to preview
+
+    step : int
+        stride of the decimated passes
+
+    scale : float
+        factor by which the thumbnails are downscaled
+    """
+    def __init__(self, video, step=50, scale=0.25):
+        self.video = video
+        self.step = step
+        self.scale = scale
+        self.thumbnails = {}
+        self.decimated = None
+        self.next_ind = None
+
+    def __len__(self):
+        return len(self.video)
+
+    def __getitem__(self, ind):
+        if ind not in self.thumbnails:
+            if ind != self.next_ind:
+                self.decimated = self.video.decimate(ind, len(self.video), self.step, scale=self.scale)
+            self.thumbnails[ind] = next(self.decimated)
+            self.next_ind = ind + self.step
+        return self.thumbnails[ind]
+
 class EyelidTracker(FrameTracker):
     """
     Object that displays a video frame with the located eyelid overlayed. Class used by eyelid_scroll method.
@@ -58,8 +101,8 @@ class EyelidTracker(FrameTracker):
         series of video frames
 
     eyelid : dictionary
-        dictionary of pupils where the key is the frame index and the value is the frame with the eyelid removed.
-        Does not need to include all video frames.
+        dictionary of eyelids where the key is the frame index and the value is the Eyelid object
+        (or the frame with the eyelid removed). Does not need to include all video frames.
     """
     def __init__(self, ax, video, eyelid_list):
         FrameTracker.__init__(self, ax, video)
@@ -69,8 +112,10 @@ class EyelidTracker(FrameTracker):
         display_img = self.video[self.ind]
         if self.ind in self.eyelid_list:
             self.eyelid_at_ind = self.eyelid_list[self.ind]
-            if self.eyelid_at_ind is not None:
+            if isinstance(self.eyelid_at_ind, np.ndarray):
                 display_img = self.eyelid_at_ind
+            elif self.eyelid_at_ind is not None:
+                display_img = self.eyelid_at_ind.apply(display_img)
         self.im.set_data(display_img)
         self.ax.set_xlabel('Frame %s' % self.ind)
         self.im.axes.figure.canvas.draw()
@@ -291,6 +336,28 @@ def frame_scroll(video):
     fig.canvas.mpl_connect('key_press_event', tracker.on_key)
     plt.show()
 
+def preview_scroll(video, step=50, scale=0.25):
+    '''
+    Allows user to scroll through downscaled video frames using the keyboard. The
+    frames are decoded as they are shown, see Thumbnails.
+
+    Parameters:
+    ------------------------
+                video : Video object
+                        video to preview
+
+                step : int
+                        number of frames skipped by the left and right keys, and stride
+                        of the decimated passes
+
+                scale : float
+                        factor by which the thumbnails are downscaled
+    '''
+    fig, ax = plt.subplots(1, 1)
+    tracker = FrameTracker(ax, Thumbnails(video, step, scale), jump=step)
+    fig.canvas.mpl_connect('key_press_event', tracker.on_key)
+    plt.show()
+
 def eyelid_scroll(video, eyelid_list):
     '''
     Overlays eyelid during frame scroll
@@ -3,7 +3,7 @@ import sys
 
 # UI
 import tkinter as tk
-from tkinter.filedialog import askopenfilename, askdirectory, asksaveasfile
+from tkinter.filedialog import askopenfilenames, askdirectory, asksaveasfile
 import matplotlib
 matplotlib.use("TkAgg")
 import numpy as np
@@ -22,14 +22,19 @@ from plotly.colors import DEFAULT_PLOTLY_COLORS
 # OTA tools
 from ota.gui import coord_click as clk
 from ota.gui import frame_scroll as scroll
-from ota.video import video as vid
+from ota.video import store
+from ota.video import segmented
 from ota.execution import pupil_locate as pl
+from ota.execution import pupil_cache
+from ota.execution import eyelid_locate as el
 from ota.execution import torsion_quant_2DX as tq2dx
 from ota.eyelid import eyelid
+from ota.eyelid import keyframes as kf
+from ota.eyelid import blink
 from ota.data import data as dat
 from ota.iris import iris, eyelid_removal
+from ota import presets as pre
 
-from tqdm import tqdm
 import cv2 as cv2
 
 
@@ -83,6 +88,13 @@ class OcularTorsionApplication(tk.Tk):
         self.blink_list = None
         self.polar_transform_list = None
         self.pupil_threshold = tk.IntVar()
+        self.pupil_tracking = tk.IntVar()
+        self.pupil_method = tk.StringVar(value='ellipse')
+        self.pupil_pyramid_levels = tk.IntVar()
+        self.pupil_cache = pupil_cache.PupilCache()
+        self.eyelid_keyframe_interval = tk.IntVar(value=1)
+        self.eyelid_method = tk.StringVar(value='hough')
+        self.blink_prefilter = tk.IntVar()
         self.data = []
 
         self.torsion = []
@@ -177,7 +189,7 @@ class OcularTorsionApplication(tk.Tk):
             # Initialize data object and append it to session list
             data = dat.Data(name=datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"),path=self.save_path.get())
             torsion_data = [torsion_data[1] for torsion_data in torsion.items()]
-            data.set(torsion = torsion_data, start_frame = self.start_frame.get(), pupil_list = self.pupil_list, metadata = metadata_dict)
+            data.set(torsion = torsion_data, start_frame = self.start_frame.get(), pupil_list = self.pupil_list, metadata = metadata_dict, frame_offset = self.video.roi_offset())
             self.data.append(data)
 
          # Determine if the user wants to run 2D correlation on subset and full iris
@@ -222,7 +234,7 @@ class OcularTorsionApplication(tk.Tk):
             # Initialize data object and append it to session list
             data = dat.Data(name=datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"),path=self.save_path.get())
             torsion_data = [torsion_data[1] for torsion_data in torsion.items()]
-            data.set(torsion = torsion_data, start_frame = self.start_frame.get(), pupil_list = self.pupil_list, metadata = metadata_dict)
+            data.set(torsion = torsion_data, start_frame = self.start_frame.get(), pupil_list = self.pupil_list, metadata = metadata_dict, frame_offset = self.video.roi_offset())
             self.data.append(data)
 
         # Determine if the user wants to run 2D correlation on a subset of the iris
@@ -272,7 +284,7 @@ class OcularTorsionApplication(tk.Tk):
                 # Initialize data object and append it to session list
                 data = dat.Data(name=datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"),path=self.save_path.get())
                 torsion_data = [torsion_data[1] for torsion_data in torsion_i.items()]
-                data.set(torsion = torsion_data, start_frame = self.start_frame.get(), pupil_list = self.pupil_list, metadata = metadata_dict)
+                data.set(torsion = torsion_data, start_frame = self.start_frame.get(), pupil_list = self.pupil_list, metadata = metadata_dict, frame_offset = self.video.roi_offset())
                 self.data.append(data)
 
     def show_frame(self, cont):
@@ -290,10 +302,33 @@ class OcularTorsionApplication(tk.Tk):
         '''
         Set the path of the video.
         '''
-        video_path = askopenfilename(initialdir = "/",title = "Select Video file",filetypes = (("AVI files","*.avi"),("all files","*.*")))
-        if video_path:
-            self.video_path.set(video_path)
-            self.video = vid.Video(self.video_path.get())
+        video_paths = askopenfilenames(initialdir = "/",title = "Select Video file(s)",filetypes = (("AVI files","*.avi"),("all files","*.*")))
+        if len(video_paths) > 1:
+            # segments of one session are analyzed as a single video
+            self.video = segmented.SegmentedVideo(list(video_paths),
+                                                  cache_size=pre.FRAME_CACHE_SIZE,
+                                                  prefetch_depth=pre.PREFETCH_DEPTH)
+            self.video_path.set(', '.join(self.video.paths))
+            self.end_frame.set(len(self.video))
+        elif video_paths:
+            self.video_path.set(video_paths[0])
+            self.video = store.open_video(self.video_path.get(),
+                                          cache_size=pre.FRAME_CACHE_SIZE,
+                                          prefetch_depth=pre.PREFETCH_DEPTH)
+            self.end_frame.set(len(self.video))
+
+    def create_frame_store(self):
+        '''
+        Decode the video once into a grayscale frame store on disk and use it for all
+        following analysis.
+        '''
+        if isinstance(self.video, segmented.SegmentedVideo):
+            print('Frame stores are created for single video files only')
+        elif self.video_path.get():
+            # keep the eye region, the pupil and eyelid lists are in its coordinates
+            roi = self.video.roi
+            self.video = store.create_frame_store(self.video_path.get())
+            self.video.set_roi(roi)
             self.end_frame.set(len(self.video))
 
     def set_save_path(self):
@@ -321,9 +356,9 @@ class OcularTorsionApplication(tk.Tk):
 
     def scroll_frames(self):
         '''
-        Scroll through video frames.
+        Scroll through downscaled video frames.
         '''
-        scroll.frame_scroll(self.video)
+        scroll.preview_scroll(self.video, step=pre.PREVIEW_STEP, scale=pre.PREVIEW_SCALE)
 
     def scroll_eyelids(self):
         '''
@@ -394,40 +429,78 @@ class OcularTorsionApplication(tk.Tk):
         fig['layout'].update(title='Iris Rotation History')
         plot(fig)
 
+    def crop_to_eye(self):
+        '''
+        Estimate the eye region from a sample of frames and crop every following read
+        of the video to it.
+        '''
+        roi = pl.estimate_roi(self.video, self.start_frame.get(), self.end_frame.get() - 1, self.pupil_threshold.get())
+        if roi is None:
+            print('Pupil not found in sampled frames, the video will not be cropped')
+        else:
+            self.video.set_roi(roi)
+            self.pupil_list = None
+            self.eyelid_list = None
+            self.blink_list = None
+
+    def sweep_pupil_threshold(self):
+        '''
+        Evaluate a range of pupil detection thresholds on a sample of frames and set the
+        pupil detection threshold to the recommended one.
+        '''
+        sweep = pl.sweep_thresholds(self.video, self.start_frame.get(), self.end_frame.get(),
+                                    step=pre.PUPIL_SWEEP_STEP, method=self.pupil_method.get())
+
+        for threshold, result in sweep.items():
+            print('Threshold %d: detection rate %.2f, area variation %.3f, fit residual %.2f px' %
+                  (threshold, result['detection_rate'], result['area_cv'], result['residual']))
+
+        threshold = pl.recommend_threshold(sweep)
+        if threshold is None:
+            print('Pupil not found with any of the thresholds, the threshold is unchanged')
+        else:
+            print('Recommended threshold: %d' % threshold)
+            self.pupil_threshold.set(threshold)
+
     def construct_pupil_list(self, measure_torsion_button):
         '''
         Constructs a list of pupils.
         '''
-        self.pupil_list = pl.construct_pupil_list(self.video, self.start_frame.get(), self.end_frame.get(), self.pupil_threshold.get())
+        self.pupil_list = self.pupil_cache.construct_pupil_list(self.video, self.start_frame.get(), self.end_frame.get(), self.pupil_threshold.get(),
+                                                                track=bool(self.pupil_tracking.get()),
+                                                                method=self.pupil_method.get(),
+                                                                pyramid_levels=self.pupil_pyramid_levels.get())
+
+    def clear_pupil_cache(self):
+        '''
+        Remove the cached pupil lists of the current video.
+        '''
+        if self.video:
+            self.pupil_cache.invalidate(self.video)
 
     def identify_eyelids(self):
         '''
         Identifies the eyelids and blinks
         '''
         if self.pupil_list:
-            self.eyelid_list = {}
-            self.blink_list = {}
-            for i, frame in tqdm(enumerate(self.video[self.start_frame.get():self.end_frame.get()])):
-                frame_loc = i + self.start_frame.get()
-                # check if a pupil exists
-                if not self.pupil_list[frame_loc]:
-                    self.eyelid_list[frame_loc] = None
-                    self.blink_list[frame_loc]  = None
-                else:
-                    try:
-                        self.eyelid_list[frame_loc] = eyelid.detect_eyelid(frame, self.pupil_list[frame_loc])
-                        self.blink_list[frame_loc] = eyelid.pupil_obstruct(self.eyelid_list[frame_loc], self.pupil_list[frame_loc].contour)
-
-                    except:
-                        self.eyelid_list[frame_loc] = None
-                        self.blink_list[frame_loc] = None
-                if i > 2 and self.blink_list[frame_loc] == 1 or self.blink_list[frame_loc] is None:
-                    self.blink_list[frame_loc - 1] = None
-                    if self.blink_list[frame_loc - 2] == 1 or self.blink_list[frame_loc - 2] is None:
-                        self.blink_list[frame_loc - 1] = None
-
-
-
+            interval = self.eyelid_keyframe_interval.get()
+            keyframes = None
+            if interval > 1:
+                keyframes = kf.EyelidKeyframes(eyelid.DETECTORS[self.eyelid_method.get()], interval=interval)
+
+            # the pupil list is already built, the filter only skips the eyelid detection
+            blink_filter = None
+            if self.blink_prefilter.get():
+                blink_filter = blink.BlinkFilter(self.pupil_threshold.get())
+
+            self.eyelid_list, self.blink_list = el.construct_eyelid_list(self.video, self.start_frame.get(), self.end_frame.get() - 1,
+                                                                         self.pupil_list, keyframes=keyframes,
+                                                                         method=self.eyelid_method.get(),
+                                                                         blink_filter=blink_filter)
+            if keyframes is not None:
+                print('Eyelids detected in %(full)d frames, interpolated in %(interpolated)d frames' % keyframes.statistics())
+            if blink_filter is not None:
+                print('%(flagged)d of %(checked)d frames skipped as blinks' % blink_filter.statistics())
 
     def identify_blinks(self):
         '''
@@ -468,6 +541,9 @@ class StartPage(tk.Frame):
         scroll_vid_button = tk.Button(self, text="Preview Video", command=lambda: controller.scroll_frames())
         scroll_vid_button.grid(row=2,column=0,sticky=tk.W)
 
+        frame_store_button = tk.Button(self, text="Create Frame Store", command=lambda: controller.create_frame_store())
+        frame_store_button.grid(row=2,column=1,sticky=tk.W)
+
         save_path_button = tk.Button(self, text="Set Results Save Path", command=lambda: controller.set_save_path())
         save_path_button.grid(row=3,column=0,sticky=tk.W)
 
@@ -498,6 +574,12 @@ class StartPage(tk.Frame):
         pupil_threshold_entry = tk.Entry(self, textvariable = controller.pupil_threshold)
         pupil_threshold_entry.grid(row=7, column=1)
 
+        crop_button = tk.Button(self, text="Crop to Eye", command=lambda: controller.crop_to_eye())
+        crop_button.grid(row=7, column=2, sticky=tk.W)
+
+        sweep_button = tk.Button(self, text="Sweep Threshold", command=lambda: controller.sweep_pupil_threshold())
+        sweep_button.grid(row=8, column=2, sticky=tk.W)
+
         pupil_loc_button = tk.Button(self, text="Construct Pupil List", command=lambda: controller.construct_pupil_list(self.measure_torsion_button))
         pupil_loc_button.grid(row=8,column=0,sticky=tk.W)
 
@@ -513,6 +595,39 @@ class StartPage(tk.Frame):
         identify_blinks_button = tk.Button(self, text="Identify Blinks", command=lambda: controller.identify_blinks())
         identify_blinks_button.grid(row=9,column=2,sticky=tk.W)
 
+        pupil_tracking_check = tk.Checkbutton(self, text="Track Pupil", variable = controller.pupil_tracking)
+        pupil_tracking_check.grid(row=10,column=0,sticky=tk.W)
+
+        clear_cache_button = tk.Button(self, text="Clear Pupil Cache", command=lambda: controller.clear_pupil_cache())
+        clear_cache_button.grid(row=10,column=1)
+
+        pupil_method_label = tk.Label(self, text="Pupil Detection Method:")
+        pupil_method_label.grid(row=11, column=0, sticky=tk.W)
+
+        pupil_method_menu = tk.OptionMenu(self, controller.pupil_method, 'ellipse', 'moments')
+        pupil_method_menu.grid(row=11, column=1, sticky=tk.W)
+
+        pupil_pyramid_label = tk.Label(self, text="Pupil Pyramid Levels:")
+        pupil_pyramid_label.grid(row=12, column=0, sticky=tk.W)
+
+        pupil_pyramid_entry = tk.Entry(self, textvariable = controller.pupil_pyramid_levels)
+        pupil_pyramid_entry.grid(row=12, column=1)
+
+        eyelid_keyframe_label = tk.Label(self, text="Eyelid Keyframe Interval:")
+        eyelid_keyframe_label.grid(row=13, column=0, sticky=tk.W)
+
+        eyelid_keyframe_entry = tk.Entry(self, textvariable = controller.eyelid_keyframe_interval)
+        eyelid_keyframe_entry.grid(row=13, column=1)
+
+        eyelid_method_label = tk.Label(self, text="Eyelid Detection Method:")
+        eyelid_method_label.grid(row=14, column=0, sticky=tk.W)
+
+        eyelid_method_menu = tk.OptionMenu(self, controller.eyelid_method, 'hough', 'fast')
+        eyelid_method_menu.grid(row=14, column=1, sticky=tk.W)
+
+        blink_prefilter_check = tk.Checkbutton(self, text="Skip Eyelid Detection in Blinks", variable = controller.blink_prefilter)
+        blink_prefilter_check.grid(row=15,column=0,sticky=tk.W)
+
 
 class MeasureTorsion(tk.Frame):
     '''
@@ -3,6 +3,7 @@
 # ====================== #
 
 from math import pi
+import os
 
 # Angular span of the correlation window
 ANGULAR_WINDOW_SPAN = 45*pi/180
@@ -26,3 +27,95 @@ REQUIRED_CORR_PREV_FRAME = 0.95
 
 
 MAX_ANGLE = 25
+
+# ===== #
+# VIDEO #
+# ===== #
+
+# Memory budget of the decoded frame cache used by the application (bytes)
+FRAME_CACHE_SIZE = 1024**3
+
+# Number of frames decoded ahead of the analysis on a worker thread
+PREFETCH_DEPTH = 8
+
+# Margin added around the sampled pupil positions when estimating the eye region (pixels)
+ROI_MARGIN = 250
+
+# Stride of the decimated decoding of the video preview, the jump of its left and right keys
+PREVIEW_STEP = 50
+
+# Downscaling factor of the video preview thumbnails
+PREVIEW_SCALE = 0.25
+
+# ===== #
+# PUPIL #
+# ===== #
+
+# Half size of the pupil tracking search window, as a multiple of the previous major axis
+PUPIL_TRACK_WINDOW = 1.5
+
+# Only every PUPIL_CONTOUR_STEP-th contour point is kept in compact pupil tracks and the
+# pupil cache. 1 keeps the full contours, so that the blink detection is unchanged, and 0
+# keeps no contours, which also skips their extraction for the 'moments' estimator
+PUPIL_CONTOUR_STEP = 1
+
+# Pupil detection thresholds evaluated by the threshold sweep
+PUPIL_SWEEP_THRESHOLDS = list(range(5, 85, 5))
+
+# Only every PUPIL_SWEEP_STEP-th frame of the range is used by the threshold sweep
+PUPIL_SWEEP_STEP = 10
+
+# Thresholds detecting the pupil in less than this fraction of the best detection rate are not recommended
+PUPIL_SWEEP_MIN_DETECTION = 0.95
+
+# Directory and maximum size in bytes of the on-disk pupil detection cache
+PUPIL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ota', 'pupil_cache')
+PUPIL_CACHE_SIZE = 512*1024**2
+
+# Pupil motion prediction, see ota.pupil.motion.MotionPredictor
+# Largest mean absolute pixel difference around the pupil for a frame to be considered unchanged
+PREDICT_MAD_THRESHOLD = 2.0
+
+# Largest pupil speed in pixels per frame for which the predicted pupil is used
+PREDICT_MAX_VELOCITY = 0.5
+
+# Distance in pixels between the predicted and detected pupil centers that resets the velocity
+PREDICT_MAX_INNOVATION = 3.0
+
+# Maximum number of consecutive predicted frames
+PREDICT_MAX_SKIP = 10
+
+# Half size of the window compared between frames, as a multiple of the pupil major axis
+PREDICT_WINDOW_SCALE = 0.75
+
+# ====== #
+# EYELID #
+# ====== #
+
+# Number of frames between full eyelid detections in keyframe mode
+EYELID_KEYFRAME_INTERVAL = 5
+
+# Largest mean absolute pixel difference along the lids for the lids to be considered unmoved
+EYELID_CHANGE_THRESHOLD = 8.0
+
+# Half height in pixels of the band sampled around each lid by the change test
+EYELID_CHANGE_BAND = 3
+
+# Column spacing in pixels of the samples taken by the change test
+EYELID_CHANGE_STEP = 4
+
+# Largest lid movement in pixels between two keyframes for which the frames between them are interpolated
+EYELID_MAX_LID_SHIFT = 3.0
+
+# Blink pre-filter, see ota.eyelid.blink.BlinkFilter
+# Smallest fraction of dark pixels inside the previous pupil for the eye to be considered open
+BLINK_MIN_DARK_FRACTION = 0.5
+
+# Largest change of the mean intensity around the previous pupil for the eye to be considered open
+BLINK_MAX_INTENSITY_JUMP = 20.0
+
+# Half size of the region around the pupil covering the iris, as a multiple of the pupil radius
+BLINK_IRIS_SCALE = 2.0
+
+# Number of consecutive flagged frames after which a frame is analyzed anyway, to find the pupil again after it moved during a blink
+BLINK_REACQUIRE_INTERVAL = 5
@@ -0,0 +1,173 @@
+import numpy as np
+import cv2
+from math import hypot
+
+from ota.pupil import pupil as pup
+from ota import presets as pre
+
+class MotionPredictor:
+    """
+    Constant velocity motion model of the pupil, used to skip the pupil detection in
+    frames where the eye does not move.
+
+    The pupil velocity is estimated from the last two detected pupils. A frame is not
+    detected when the predicted motion is small and the window around the last detected
+    pupil is unchanged since the detection, in which case the last detected pupil is
+    reused, or matches the detection window moved by the whole pixel displacement
+    predicted from the velocity, in which case the last detected pupil is moved by that
+    displacement. The change is measured as the mean absolute difference of the pixel
+    values. A detection far from the prediction (large innovation) resets the velocity
+    of the model.
+
+    The predicted pupils are therefore only used where the image around them matches
+    the last detection, and their centers stay within about one pixel of a full
+    detection.
+    """
+
+    def __init__(self, mad_threshold=pre.PREDICT_MAD_THRESHOLD, max_velocity=pre.PREDICT_MAX_VELOCITY,
+                 max_innovation=pre.PREDICT_MAX_INNOVATION, max_skip=pre.PREDICT_MAX_SKIP, window_scale=pre.PREDICT_WINDOW_SCALE):
+        """
+        Parameters
+        ------------------------
+        mad_threshold : float
+            Largest mean absolute difference of the pixel values inside the window for
+            which the frame is considered unchanged
+        max_velocity : float
+            Largest pupil speed, in pixels per frame, for which the prediction is used
+        max_innovation : float
+            Distance in pixels between the predicted and detected pupil centers above
+            which the velocity is reset
+        max_skip : int
+            Maximum number of consecutive predicted frames, a detection is forced after it
+        window_scale : float
+            Half size of the window compared between frames, as a multiple of the pupil
+            major axis, see pupil.tracking_window
+
+        Attributes
+        ------------------------
+        predicted : int
+            Number of frames where the predicted pupil was used
+        detected : int
+            Number of frames where the pupil was detected
+        resets : int
+            Number of velocity resets after a large innovation
+        """
+        self.mad_threshold = mad_threshold
+        self.max_velocity = max_velocity
+        self.max_innovation = max_innovation
+        self.max_skip = max_skip
+        self.window_scale = window_scale
+
+        self.predicted = 0
+        self.detected = 0
+        self.resets = 0
+
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the motion state, the next frame is always detected.
+        """
+        self.pupil = None
+        self.velocity = (0.0, 0.0)
+        self.steps = 0
+        self.window = None
+        self.reference = None
+
+    def prediction(self):
+        """
+        Returns the predicted (column, row) of the pupil center in the next frame, or
+        None if there is no detected pupil.
+        """
+        if self.pupil is None:
+            return None
+        steps = self.steps + 1
+        return (self.pupil.center_col + steps*self.velocity[0], self.pupil.center_row + steps*self.velocity[1])
+
+    def predict(self, frame):
+        """
+        Predict the pupil of a frame if the frame is stable enough.
+
+        Parameters
+        ------------------------
+        frame : array_like
+            Grayscale video frame
+
+        Returns
+        ------------------------
+        pupil : Pupil
+            Predicted pupil, or None if the pupil must be detected. The last detected
+            pupil, or a copy of it moved by the predicted whole pixel displacement.
+        """
+        if self.pupil is None or self.steps >= self.max_skip or hypot(*self.velocity) > self.max_velocity:
+            return None
+
+        # the pupil did not move since the last detection
+        if self.__unchanged(frame, 0, 0):
+            self.steps += 1
+            self.predicted += 1
+            return self.pupil
+
+        # the pupil moved by the predicted displacement
+        col, row = self.prediction()
+        shift_col = int(round(col - self.pupil.center_col))
+        shift_row = int(round(row - self.pupil.center_row))
+        if (shift_col, shift_row) == (0, 0) or not self.__unchanged(frame, shift_col, shift_row):
+            return None
+
+        self.steps += 1
+        self.predicted += 1
+
+        contour = self.pupil.contour
+        if contour is not None:
+            contour = contour + np.array([shift_col, shift_row], dtype=contour.dtype)
+
+        return pup.pupil_from_properties(self.pupil.center_col + shift_col, self.pupil.center_row + shift_row, self.pupil.radius,
+                                         self.pupil.major, self.pupil.minor, self.pupil.angle, contour)
+
+    def __unchanged(self, frame, shift_col, shift_row):
+        # compare the window of the last detection, moved by the shift, with its reference
+        top, bottom, left, right = self.window
+        top, bottom, left, right = top + shift_row, bottom + shift_row, left + shift_col, right + shift_col
+        if top < 0 or left < 0 or bottom > frame.shape[0] or right > frame.shape[1]:
+            return False
+        return cv2.absdiff(frame[top:bottom, left:right], self.reference).mean() <= self.mad_threshold
+
+    def update(self, frame, pupil):
+        """
+        Update the motion model with the pupil detected in a frame.
+
+        Parameters
+        ------------------------
+        frame : array_like
+            Grayscale video frame
+        pupil : Pupil
+            Pupil detected in the frame, or None if no pupil was found
+        """
+        self.detected += 1
+
+        if pupil is None:
+            self.reset()
+            return
+
+        predicted = self.prediction()
+        if predicted is not None:
+            if hypot(pupil.center_col - predicted[0], pupil.center_row - predicted[1]) > self.max_innovation:
+                self.velocity = (0.0, 0.0)
+                self.resets += 1
+            else:
+                steps = self.steps + 1
+                self.velocity = ((pupil.center_col - self.pupil.center_col)/steps, (pupil.center_row - self.pupil.center_row)/steps)
+
+        self.pupil = pupil
+        self.steps = 0
+        self.window = pup.tracking_window(pupil, frame.shape, scale=self.window_scale)
+
+        top, bottom, left, right = self.window
+        self.reference = frame[top:bottom, left:right].copy()
+
+    def statistics(self):
+        """
+        Returns a dictionary of the number of predicted and detected frames.
+        """
+        return {'predicted': self.predicted, 'detected': self.detected, 'resets': self.resets}
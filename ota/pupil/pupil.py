@@ -1,23 +1,154 @@
 import numpy as np
 import cv2, pdb, os
 from matplotlib import pyplot as plt
-from ota.eyelid.eyelid import pupil_obstruct
 
 import scipy as sp
 from scipy import ndimage
 from math import *
-from ota.eyelid.eyelid import pupil_obstruct
 
 class EmptyAreas(Exception):
     def __init__(self):
         Exception.__init__(self,'No distinct pupil area detected following thresholding, frame may be overexposed or eye might be closed.')
 
+class PupilOutsideWindow(Exception):
+    def __init__(self):
+        Exception.__init__(self,'Pupil touches the edge of the search window, the full frame must be searched.')
+
+def tracking_window(pupil, shape, scale=1.5):
+    """
+    Search window around a pupil, used to look for the pupil of the next frame.
+
+    Parameters
+    ------------------------
+    pupil : Pupil
+        Pupil found in the previous frame
+    shape : tuple
+        Shape of the frame (rows, columns)
+    scale : float
+        Half size of the window as a multiple of the pupil major axis
+
+    Returns
+    ------------------------
+    window : tuple
+        (top, bottom, left, right) pixel bounds of the window, clipped to the frame
+    """
+    half = int(ceil(scale * pupil.major)) + 1
+    row = int(pupil.center_row)
+    col = int(pupil.center_col)
+    return (max(0, row - half), min(shape[0], row + half + 1),
+            max(0, col - half), min(shape[1], col + half + 1))
+
+def pyramid_window(frame, threshold=10, levels=1, scale=0.75):
+    """
+    Coarse pupil localization on a frame downscaled levels times with cv2.pyrDown.
+    Returns a full resolution window around the coarse pupil, in which the pupil can
+    be refined.
+
+    Parameters
+    ------------------------
+    frame : array_like
+        Grayscale video frame containing pupil to be detected
+    threshold: Uint8
+        Integer representing the value to use for image binary thresholding.
+    levels : int
+        Number of pyramid levels, the frame is downscaled by 2**levels
+    scale : float
+        Half size of the window as a multiple of the coarse pupil major axis. A
+        margin of two coarse pixels is added to absorb the downscaling error.
+
+    Returns
+    ------------------------
+    window : tuple
+        (top, bottom, left, right) pixel bounds of the window in the full frame
+    """
+    small = frame
+    for _ in range(levels):
+        small = cv2.pyrDown(small)
+
+    ret, I = cv2.threshold(small, threshold, 255, cv2.THRESH_BINARY_INV)
+    col, row, radius, major_axis_length, minor_axis_length, angle, blob = largest_blob_moments(I)
+
+    # map the coarse estimate back to full resolution pixel coordinates
+    factor = 2**levels
+    col = (col + 0.5)*factor - 0.5
+    row = (row + 0.5)*factor - 0.5
+    half = int(ceil(scale*major_axis_length*factor)) + 2*factor
+
+    return (max(0, int(row) - half), min(frame.shape[0], int(row) + half + 1),
+            max(0, int(col) - half), min(frame.shape[1], int(col) + half + 1))
+
+def largest_blob_moments(binary):
+    """
+    Estimate the pupil as the largest connected blob of a binary image, using
+    second order image moments instead of a contour based ellipse fit.
+
+    The center is the blob centroid. The axes are those of the ellipse with the same
+    second order central moments as the blob, ie. 4 * sqrt(eigenvalue) of the blob
+    covariance matrix. The angle follows the cv2.fitEllipse convention: the direction
+    of the minor axis, in degrees.
+
+    Parameters
+    -----------------------
+    binary : array_like
+        Binary uint8 image where nonzero pixels may be pupil
+
+    Returns
+    -----------------------
+    col, row, radius, major, minor, angle : float
+        Pupil properties relative to the binary image, see Pupil.
+    blob : tuple
+        (bits, (height, width), (column offset, row offset)) mask of the blob bounding
+        box packed to one bit per pixel, its size and its position in the binary image,
+        used to extract the contour when needed, see blob_contour.
+    """
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(binary, connectivity=8)
+
+    # label 0 is the background
+    if num_labels <= 1:
+        raise EmptyAreas
+
+    label = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+    x, y, w, h = stats[label, :4]
+
+    mask = (labels[y:y+h, x:x+w] == label).astype(np.uint8)
+    m = cv2.moments(mask, binaryImage=True)
+
+    col = x + m['m10']/m['m00']
+    row = y + m['m01']/m['m00']
+
+    # normalized central moments, ie. the blob covariance matrix
+    mu20 = m['mu20']/m['m00']
+    mu02 = m['mu02']/m['m00']
+    mu11 = m['mu11']/m['m00']
+
+    spread = sqrt(((mu20 - mu02)/2)**2 + mu11**2)
+    major_axis_length = 4*sqrt((mu20 + mu02)/2 + spread)
+    minor_axis_length = 4*sqrt(max((mu20 + mu02)/2 - spread, 0))
+
+    # orientation of the major axis, the minor axis is perpendicular to it
+    angle = (degrees(0.5*atan2(2*mu11, mu20 - mu02)) + 90) % 180
+
+    radius = (major_axis_length + minor_axis_length)/4
+
+    return col, row, radius, major_axis_length, minor_axis_length, angle, (np.packbits(mask), (int(h), int(w)), (int(x), int(y)))
+
+def blob_contour(blob):
+    """
+    Extract the outer contour of a blob returned by largest_blob_moments.
+    """
+    bits, (h, w), offset = blob
+    mask = np.unpackbits(bits, count=h*w).reshape(h, w)
+    img, contours, heighrarchy = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=offset)
+    return max(contours, key=cv2.contourArea)
+
 class Pupil:
     """
     Object to represent a pupil within a specific frame of the video.
     """
 
-    def __init__(self, frame, threshold=10, skip_init=False):
+    __slots__ = ('center_col', 'center_row', 'radius', 'major', 'minor', 'angle', '_contour', '_blob')
+
+    def __init__(self, frame, threshold=10, skip_init=False, window=None, method='ellipse', pyramid_levels=0):
         """
         Initialize pupil object and find it's center, and radius within frame
 
@@ -27,6 +158,22 @@ class Pupil:
             Grayscale video frame containing pupil to be detected
         threshold: Uint8
             Integer representing the value to use for image binary thresholding.
+        window: tuple
+            Optional (top, bottom, left, right) bounds of the frame region to search.
+            Pupil properties are still given in frame coordinates.
+        method: String
+            Estimator used to find the pupil properties.
+            'ellipse' - least squares ellipse fit to the pupil contour
+            'moments' - image moments of the largest dark blob, the contour is only
+                        extracted when it is first accessed
+        pyramid_levels: int
+            If nonzero and no window is given, the pupil is first located on the frame
+            downscaled by 2**pyramid_levels (see pyramid_window) and then refined at full
+            resolution inside a small window around the coarse estimate. The refined
+            pupil is fitted to the same full resolution pixels as a full frame search, so
+            the results are identical to it (the tolerance is 0 pixels) whenever the pupil
+            is the largest dark blob in the frame. If the pupil is not found inside the
+            window or touches its edge, the full frame is searched instead.
 
         Attributes
         ------------------------
@@ -51,15 +198,93 @@ class Pupil:
             False : frame does not record a blink
         """
 
-        if skip_init is False:
-            self.center_col, self.center_row, self.radius, self.major, self.minor, self.contour, self.angle = self.calc_pupil_properties_fit_ellipse(frame, threshold=threshold)
+        self._blob = None
+
+        if skip_init is False and pyramid_levels and window is None:
+            # coarse to fine, fall back to the full frame if the refinement fails
+            try:
+                self.__detect(frame, threshold, pyramid_window(frame, threshold, pyramid_levels), method)
+            except (EmptyAreas, PupilOutsideWindow):
+                self.__detect(frame, threshold, None, method)
+        elif skip_init is False:
+            self.__detect(frame, threshold, window, method)
         else:
             self.center_col = None
             self.center_row = None
             self.radius = None
+            self.major = None
+            self.minor = None
+            self.angle = None
+            self.contour = None
+
+    def __detect(self, frame, threshold, window, method):
+        """
+        Find the pupil properties with the selected estimator and set the attributes.
+        """
+        if method == 'moments':
+            self.center_col, self.center_row, self.radius, self.major, self.minor, blob, self.angle = self.calc_pupil_properties_moments(frame, threshold=threshold, window=window)
             self.contour = None
+            self._blob = blob
+        else:
+            self.center_col, self.center_row, self.radius, self.major, self.minor, self.contour, self.angle = self.calc_pupil_properties_fit_ellipse(frame, threshold=threshold, window=window)
+
+    @property
+    def contour(self):
+        """
+        Contour of the pupil. Pupils found with image moments extract it on first access.
+        """
+        if self._contour is None and self._blob is not None:
+            self._contour = blob_contour(self._blob)
+            self._blob = None
+        return self._contour
 
-    def calc_pupil_properties_fit_ellipse(self, frame, threshold=10):
+    @contour.setter
+    def contour(self, value):
+        self._contour = value
+        self._blob = None
+
+    def calc_pupil_properties_moments(self, frame, threshold=10, window=None):
+        """
+        Find the location of the pupil center, axes and tilt from the second order image
+        moments of the largest dark blob, without extracting its contour.
+
+        Parameters
+        -----------------------
+        frame : array_like
+            Grayscale video frame containing pupil to be detected
+        threshold: Uint8
+            Integer representing the value to use for image binary thresholding.
+        window: tuple
+            Optional (top, bottom, left, right) bounds of the frame region to search.
+            Raises PupilOutsideWindow if the pupil touches an edge of the window that is
+            not an edge of the frame.
+
+        Returns
+        -----------------------
+        col, row, radius, major, minor : float
+            See calc_pupil_properties_fit_ellipse
+        blob : tuple
+            Packed mask of the pupil blob in frame coordinates, see largest_blob_moments,
+            used to extract the contour when needed.
+        angle : float
+            Value representing the tilt of the pupil
+        """
+        rows, cols = frame.shape[:2]
+        top, bottom, left, right = (0, rows, 0, cols) if window is None else window
+
+        # Threshold the image
+        ret, I = cv2.threshold(frame[top:bottom, left:right], threshold, 255, cv2.THRESH_BINARY_INV)
+
+        col, row, radius, major_axis_length, minor_axis_length, angle, (bits, (h, w), (x, y)) = largest_blob_moments(I)
+
+        # The pupil may continue outside of the window
+        if window is not None and ((left > 0 and x == 0) or (top > 0 and y == 0) or
+                                   (right < cols and left + x + w >= right) or (bottom < rows and top + y + h >= bottom)):
+            raise PupilOutsideWindow
+
+        return col + left, row + top, radius, major_axis_length, minor_axis_length, (bits, (h, w), (x + left, y + top)), angle
+
+    def calc_pupil_properties_fit_ellipse(self, frame, threshold=10, window=None):
         """
         Find the location of the pupil center and the radius of the pupil within frame using a best fit ellipse.
 
@@ -69,6 +294,10 @@ class Pupil:
             Grayscale video frame containing pupil to be detected
         threshold: Uint8
             Integer representing the value to use for image binary thresholding.
+        window: tuple
+            Optional (top, bottom, left, right) bounds of the frame region to search.
+            Raises PupilOutsideWindow if the pupil touches an edge of the window that is
+            not an edge of the frame.
 
         Returns
         -----------------------
@@ -89,11 +318,16 @@ class Pupil:
         angle : float
             Value representing the tilt of the pupil
         """
+        # Only search the window, contours are offset back into frame coordinates
+        rows, cols = frame.shape[:2]
+        top, bottom, left, right = (0, rows, 0, cols) if window is None else window
+        frame = frame[top:bottom, left:right]
+
         # Threshold the image
         ret, I = cv2.threshold(frame, threshold, 255, cv2.THRESH_BINARY_INV)
 
         # Get a list of contours within the image
-        img, contours, heighrarchy =  cv2.findContours(I, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        img, contours, heighrarchy =  cv2.findContours(I, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=(left, top))
 
         # Get the index corresponding to the contour with the maximum enclosed area
         areas = []
@@ -111,6 +345,13 @@ class Pupil:
         # Get the list of contour points that enclose the max area
         pupil_cnt = contours[max_area_ind]
 
+        # The pupil may continue outside of the window
+        if window is not None:
+            x, y, w, h = cv2.boundingRect(pupil_cnt)
+            if (left > 0 and x <= left) or (top > 0 and y <= top) or \
+               (right < cols and x + w >= right) or (bottom < rows and y + h >= bottom):
+                raise PupilOutsideWindow
+
         # Fit an ellipse to the pupil contour in a least squares sense
         ellipse = cv2.fitEllipse(pupil_cnt)
 
@@ -178,3 +419,132 @@ class Pupil:
         (col, row), radius = cv2.minEnclosingCircle(pupil_cnt)
 
         return col, row, radius, pupil_cnt
+
+
+def pupil_from_properties(center_col, center_row, radius, major, minor, angle, contour=None, blob=None):
+    """
+    Create a pupil object from already measured properties, without any detection.
+    If a blob of largest_blob_moments is given instead of the contour, the contour is
+    extracted from it when it is first accessed.
+
+    Returns
+    -----------------------
+    pupil : Pupil
+        Pupil object with the given attributes, see Pupil.
+    """
+    pupil = Pupil(None, skip_init=True)
+    pupil.center_col = center_col
+    pupil.center_row = center_row
+    pupil.radius = radius
+    pupil.major = major
+    pupil.minor = minor
+    pupil.angle = angle
+    pupil.contour = contour
+    pupil._blob = blob
+    return pupil
+
+def fit_residual(pupil):
+    """
+    Mean distance between the pupil contour points and the fitted pupil ellipse.
+
+    The distance of a point is approximated by its normalized radial offset from the
+    ellipse, scaled by the pupil radius.
+
+    Parameters
+    -----------------------
+    pupil : Pupil
+        Pupil with a contour
+
+    Returns
+    -----------------------
+    residual : float
+        Mean distance in pixels, NaN if the pupil has no contour or axes
+    """
+    contour = pupil.contour
+    if contour is None or not pupil.major or not pupil.minor:
+        return np.nan
+
+    points = contour.reshape(-1, 2).astype(np.float64)
+    dc = points[:, 0] - pupil.center_col
+    dr = points[:, 1] - pupil.center_row
+
+    # rotate into the ellipse axes, the minor axis is along the angle (see cv2.fitEllipse)
+    theta = np.deg2rad(pupil.angle)
+    u = np.cos(theta)*dc + np.sin(theta)*dr
+    v = -np.sin(theta)*dc + np.cos(theta)*dr
+
+    offset = np.sqrt((2*u/pupil.minor)**2 + (2*v/pupil.major)**2) - 1
+    return float(np.mean(np.abs(offset))*pupil.radius)
+
+def detect_pupils(frames, threshold=10, return_contours=False, method='ellipse', return_blobs=False):
+    """
+    Find the pupil in every frame of a stack, equivalent to Pupil.calc_pupil_properties_fit_ellipse
+    (or Pupil.calc_pupil_properties_moments) on each frame.
+
+    The whole stack is thresholded in a single vectorized operation, the per frame
+    work is only the extraction of the largest dark blob and the ellipse fit.
+
+    Parameters
+    -----------------------
+    frames : array_like
+        (N, H, W) stack of grayscale frames
+    threshold: Uint8
+        Integer representing the value to use for image binary thresholding.
+    return_contours : boolean
+        If True, also return the pupil contour of every frame.
+    method : String
+        'ellipse' - least squares ellipse fit to the pupil contour
+        'moments' - image moments of the largest dark blob
+    return_blobs : boolean
+        With method 'moments' and return_contours, return the packed blob of every
+        frame (see largest_blob_moments) instead of its contour, so that the contours
+        are only extracted when needed, see pupil_from_properties.
+
+    Returns
+    -----------------------
+    center_col, center_row, radius, major, minor, angle : array_like
+        (N,) arrays of the pupil properties of every frame, see Pupil. NaN where no
+        pupil was found.
+    contours : list
+        Only if return_contours is True. Pupil contour of every frame, None where no
+        pupil was found.
+    """
+    # equivalent to THRESH_BINARY_INV, pixels at or below the threshold are pupil
+    binary = (np.asarray(frames) <= threshold).view(np.uint8)
+
+    num_frames = len(binary)
+    properties = np.full((6, num_frames), np.nan)
+    contours = [None] * num_frames
+
+    for i in range(num_frames):
+        if method == 'moments':
+            try:
+                col, row, radius, major_axis_length, minor_axis_length, angle, blob = largest_blob_moments(binary[i])
+            except EmptyAreas:
+                continue
+            properties[:, i] = col, row, radius, major_axis_length, minor_axis_length, angle
+            if return_contours:
+                contours[i] = blob if return_blobs else blob_contour(blob)
+            continue
+
+        img, frame_contours, heighrarchy = cv2.findContours(binary[i], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        if not frame_contours:
+            continue
+
+        pupil_cnt = max(frame_contours, key=cv2.contourArea)
+
+        # an ellipse needs at least 5 points
+        if len(pupil_cnt) < 5:
+            continue
+
+        (col, row), (minor_axis_length, major_axis_length), angle = cv2.fitEllipse(pupil_cnt)
+        radius = (major_axis_length + minor_axis_length)/4
+
+        properties[:, i] = col, row, radius, major_axis_length, minor_axis_length, angle
+        contours[i] = pupil_cnt
+
+    center_col, center_row, radius, major, minor, angle = properties
+
+    if return_contours:
+        return center_col, center_row, radius, major, minor, angle, contours
+    return center_col, center_row, radius, major, minor, angle
@@ -0,0 +1,212 @@
+import numpy as np
+
+from ota.pupil import pupil as pup
+
+# One record per frame of the track
+TRACK_DTYPE = np.dtype([('frame', np.int64),
+                        ('center_col', np.float64),
+                        ('center_row', np.float64),
+                        ('radius', np.float64),
+                        ('major', np.float64),
+                        ('minor', np.float64),
+                        ('angle', np.float64),
+                        ('valid', np.bool_)])
+
+PROPERTIES = ('center_col', 'center_row', 'radius', 'major', 'minor', 'angle')
+
+class PupilTrack:
+    """
+    Compact pupil list for a contiguous range of frames.
+
+    The pupil properties are kept in one NumPy structured array with a record per
+    frame, and the (optionally decimated) pupil contours are concatenated in one
+    ragged point buffer. The track supports the dictionary interface of the pupil
+    lists returned by construct_pupil_list: indexing with a frame number returns a
+    Pupil object, or None if no pupil was found in the frame.
+    """
+
+    def __init__(self, first_frame, last_frame, contour_step=1):
+        """
+        Create an empty track, every frame of the range is initially without a pupil.
+
+        Parameters
+        ------------------------
+        first_frame : int
+            Index of the first frame of the track
+        last_frame : int
+            Index of the last frame of the track (inclusive)
+        contour_step : int
+            Only every contour_step-th contour point is kept. If 0 or None, the
+            contours are not stored and the pupils of the track have no contour.
+
+        Attributes
+        ------------------------
+        records : array_like
+            Structured array of TRACK_DTYPE, one record per frame. The properties of
+            frames without a pupil are NaN and their valid flag is False.
+        points : array_like
+            (M, 1, 2) int32 buffer of the stored contour points of all frames
+        offsets : array_like
+            The contour points of the i-th frame of the track are
+            points[offsets[i]:offsets[i+1]]
+        """
+        self.first_frame = first_frame
+        self.contour_step = contour_step
+
+        num_frames = max(0, last_frame - first_frame + 1)
+        self.records = np.zeros(num_frames, dtype=TRACK_DTYPE)
+        self.records['frame'] = np.arange(first_frame, first_frame + num_frames)
+        for name in PROPERTIES:
+            self.records[name] = np.nan
+
+        self.points = np.empty((0, 1, 2), dtype=np.int32)
+        self.offsets = np.zeros(num_frames + 1, dtype=np.int64)
+
+        # contours set since the point buffer was last packed, by record index
+        self._pending = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, frame_loc):
+        return isinstance(frame_loc, (int, np.integer)) and 0 <= frame_loc - self.first_frame < len(self.records)
+
+    def __index(self, frame_loc):
+        if frame_loc not in self:
+            raise KeyError(frame_loc)
+        return int(frame_loc - self.first_frame)
+
+    def __getitem__(self, frame_loc):
+        i = self.__index(frame_loc)
+        record = self.records[i]
+        if not record['valid']:
+            return None
+
+        return pup.pupil_from_properties(*[float(record[name]) for name in PROPERTIES], contour=self.contour(frame_loc))
+
+    def __setitem__(self, frame_loc, pupil):
+        i = self.__index(frame_loc)
+        record = self.records[i]
+
+        if pupil is None:
+            for name in PROPERTIES:
+                record[name] = np.nan
+            record['valid'] = False
+            contour = None
+        else:
+            for name in PROPERTIES:
+                value = getattr(pupil, name)
+                record[name] = np.nan if value is None else value
+            record['valid'] = True
+            contour = pupil.contour if self.contour_step else None
+
+        if contour is None:
+            self._pending[i] = self.points[:0]
+        else:
+            self._pending[i] = np.asarray(contour, dtype=np.int32).reshape(-1, 1, 2)[::self.contour_step]
+
+    def __getstate__(self):
+        '''
+        Pickle support. The pending contours are packed so that only the arrays are sent.
+        '''
+        self.pack()
+        return self.__dict__.copy()
+
+    def get(self, frame_loc, default=None):
+        return self[frame_loc] if frame_loc in self else default
+
+    def keys(self):
+        return range(self.first_frame, self.first_frame + len(self.records))
+
+    def values(self):
+        return (self[frame_loc] for frame_loc in self.keys())
+
+    def items(self):
+        return ((frame_loc, self[frame_loc]) for frame_loc in self.keys())
+
+    def update(self, pupil_list):
+        """
+        Copy the pupils of another track or pupil dictionary into the track.
+        """
+        if isinstance(pupil_list, PupilTrack) and pupil_list.contour_step == self.contour_step:
+            pupil_list.pack()
+            for frame_loc in pupil_list.keys():
+                i = self.__index(frame_loc)
+                j = frame_loc - pupil_list.first_frame
+                self.records[i] = pupil_list.records[j]
+                self._pending[i] = pupil_list.points[pupil_list.offsets[j]:pupil_list.offsets[j+1]]
+        else:
+            for frame_loc, pupil in pupil_list.items():
+                self[frame_loc] = pupil
+
+    def valid(self):
+        """
+        Returns the boolean array of the frames of the track with a pupil.
+        """
+        return self.records['valid']
+
+    def contour(self, frame_loc):
+        """
+        Returns the stored contour of a frame, or None if no contour is stored.
+        """
+        i = self.__index(frame_loc)
+        if i in self._pending:
+            contour = self._pending[i]
+        else:
+            contour = self.points[self.offsets[i]:self.offsets[i+1]]
+        return contour if len(contour) else None
+
+    def select(self, first_frame, last_frame):
+        """
+        Returns a new track with the frames [first_frame, last_frame] of the track.
+        """
+        i = self.__index(first_frame)
+        j = self.__index(last_frame) + 1
+        self.pack()
+
+        track = PupilTrack(first_frame, last_frame, self.contour_step)
+        track.records[:] = self.records[i:j]
+        track.points = self.points[self.offsets[i]:self.offsets[j]].copy()
+        track.offsets = self.offsets[i:j+1] - self.offsets[i]
+        return track
+
+    def pack(self):
+        """
+        Merge the contours set since the last call into the ragged point buffer.
+        """
+        if not self._pending:
+            return
+
+        parts = [self._pending.get(i, self.points[self.offsets[i]:self.offsets[i+1]]) for i in range(len(self.records))]
+        lengths = np.array([len(part) for part in parts], dtype=np.int64)
+
+        self.offsets = np.zeros(len(self.records) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.points = np.concatenate(parts) if parts else self.points[:0]
+        self._pending = {}
+
+def from_arrays(records, points, offsets, contour_step=1):
+    """
+    Create a track from the arrays of a packed track, see PupilTrack.
+    """
+    first_frame = int(records['frame'][0]) if len(records) else 0
+    track = PupilTrack(first_frame, first_frame + len(records) - 1, contour_step)
+    track.records[:] = records
+    track.points = np.asarray(points, dtype=np.int32).reshape(-1, 1, 2)
+    track.offsets = np.asarray(offsets, dtype=np.int64)
+    return track
+
+def from_pupil_list(pupil_list, contour_step=1):
+    """
+    Convert a dictionary of pupil objects to a PupilTrack over its frame range.
+    """
+    if not pupil_list:
+        return PupilTrack(0, -1, contour_step)
+
+    track = PupilTrack(min(pupil_list), max(pupil_list), contour_step)
+    track.update(pupil_list)
+    track.pack()
+    return track
@@ -4,6 +4,8 @@ Generate manually rotated frames for testing torsion quantification methods.
 import cv2
 import numpy as np
 
+from ota.video.video import ArrayVideo
+
 
 # TODO add noise, randomness and cyclic rotations
 def make_rotations(image, max_angle, num_frames=None, resolution=1, transform=None):
@@ -62,3 +64,21 @@ def make_rotations(image, max_angle, num_frames=None, resolution=1, transform=No
             frames.append(rotated)
 
     return frames
+
+def make_rotation_video(image, max_angle, fps=30, **kwargs):
+    '''
+    Create an in memory video of manually rotated images, see make_rotations.
+
+    The returned ArrayVideo can be passed directly to the analysis pipeline without
+    writing and decoding a temporary video file.
+
+    INPUT
+        image - NxM image as numpy array
+        max_angle - Maximum rotation of the last frame
+        fps - Frame rate reported by the video
+        kwargs - Extra parameters passed on to make_rotations
+
+    OUTPUT
+        video - ArrayVideo of the rotated frames
+    '''
+    return ArrayVideo(make_rotations(image, max_angle, **kwargs), fps=fps)
@@ -0,0 +1,238 @@
+'''
+Virtual video over a recording session that was split into several video files.
+'''
+import bisect
+import glob
+import os
+import re
+
+import numpy as np
+
+from ota.video import video as vid
+
+class SegmentMismatchError(Exception):
+    '''
+    Video segments do not share the same frame size or frame rate.
+    '''
+    def __init__(self, message):
+        self.message = message
+
+def numbered_segments(pattern):
+    '''
+    Returns the video files matching a glob pattern, ordered by the last number in
+    their file name.
+
+    ex. numbered_segments('/data/session_*.avi')
+        ['/data/session_1.avi', '/data/session_2.avi', ..., '/data/session_10.avi']
+    '''
+    def segment_number(path):
+        numbers = re.findall(r'\d+', os.path.basename(path))
+        return (int(numbers[-1]) if numbers else -1, path)
+
+    return sorted(glob.glob(pattern), key=segment_number)
+
+class SegmentedVideo:
+    '''
+    Presents several video files of one recording session as a single video with a
+    global frame index. Frame i of the session is frame i - offset of the segment
+    that contains it.
+
+    Supports len(), indexing, slicing (across segment boundaries), iteration,
+    read_batch, decimate and a region of interest like Video.
+    '''
+
+    def __init__(self, paths, **kwargs):
+        '''
+        Create a SegmentedVideo object from a list of video files in session order.
+
+        Inputs:
+            paths - list of video file locations, in order
+            kwargs - extra parameters passed on to the Video of every segment. The
+                segments share one decoded frame cache of cache_size bytes.
+        '''
+        if not paths:
+            raise vid.VideoDoesNotExistError('No video segments were given')
+
+        if kwargs.get('cache_size'):
+            kwargs['cache_size'] = vid.FrameCache(kwargs['cache_size'])
+
+        self.segments = [vid.Video(path, **kwargs) for path in paths]
+        self.paths = [segment.path for segment in self.segments]
+        self.path = self.paths[0]
+
+        first = self.segments[0]
+        for segment in self.segments[1:]:
+            if (segment.width, segment.height, segment.fps) != (first.width, first.height, first.fps):
+                raise SegmentMismatchError('Segment {} is {}x{} at {} fps, expected {}x{} at {} fps'.format(
+                    segment.path, segment.width, segment.height, segment.fps, first.width, first.height, first.fps))
+
+        self.width = first.width
+        self.height = first.height
+        self.fps = first.fps
+        self.grayscale = first.grayscale
+        self.roi = first.roi
+
+        # global index of the first frame of every segment, plus the total length
+        self.offsets = [0]
+        for segment in self.segments:
+            self.offsets.append(self.offsets[-1] + len(segment))
+
+    def __len__(self):
+        '''
+        Return the total number of frames of all segments.
+        '''
+        return self.offsets[-1]
+
+    def __iter__(self):
+        '''
+        Object iteration.
+        '''
+        for segment in self.segments:
+            yield from segment[0:len(segment)]
+
+    def locate(self, index):
+        '''
+        Returns the segment number containing a global frame index and the index of
+        the frame within that segment.
+        '''
+        if len(self) <= index or index < 0:
+            raise vid.OutOfIndexError('Please specify an index within 0 and {}'.format(len(self)))
+
+        k = bisect.bisect_right(self.offsets, index) - 1
+        return k, index - self.offsets[k]
+
+    def segment_ranges(self, start, stop, step=1):
+        '''
+        Map the global range(start, stop, step) onto the segments.
+
+        Outputs:
+            ranges - list of (segment number, local start, local stop) for every
+                     segment containing frames of the range, in order
+        '''
+        ranges = []
+        for k, segment in enumerate(self.segments):
+            lower, upper = self.offsets[k], self.offsets[k + 1]
+            if upper <= start or stop <= lower:
+                continue
+            # first frame of the range in this segment, keeping the global stride
+            first = start if start >= lower else start + -(-(lower - start) // step) * step
+            last = min(stop, upper)
+            if first < last:
+                ranges.append((k, first - lower, last - lower))
+        return ranges
+
+    def __getitem__(self, index):
+        '''
+        Array-like access with a global frame index. Slices return a generator that
+        continues from one segment into the next.
+
+        ex. v[0] or v[1:10]
+        '''
+        def gen(start, stop, step):
+            for k, first, last in self.segment_ranges(start, stop, step):
+                yield from self.segments[k][first:last:step]
+
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step < 0:
+                raise vid.OutOfIndexError('Reverse slices of segmented videos are not supported')
+            return gen(start, stop, step)
+
+        k, local = self.locate(index)
+        return self.segments[k][local]
+
+    def set_roi(self, roi):
+        '''
+        Crop every frame of every segment to a region of interest, see Video.set_roi.
+        '''
+        for segment in self.segments:
+            segment.set_roi(roi)
+        self.roi = self.segments[0].roi
+
+    def roi_offset(self):
+        '''
+        Returns the position of the top left corner of the region of interest in
+        full frame coordinates as a dictionary {'c': column index, 'r': row index}.
+        '''
+        return self.segments[0].roi_offset()
+
+    def frame_shape(self):
+        '''
+        Returns the shape of the frames returned by reads.
+        '''
+        return self.segments[0].frame_shape()
+
+    def read_batch(self, start, stop, out=None):
+        '''
+        Decode the frames in global range(start, stop) into a contiguous stack,
+        reading each segment with Video.read_batch. Same interface as Video.read_batch.
+        '''
+        if start < 0 or stop > len(self) or stop < start:
+            raise vid.OutOfIndexError('Please specify a range within 0 and {}'.format(len(self)))
+
+        shape = (stop - start,) + self.frame_shape()
+        if out is None:
+            out = np.empty(shape, dtype=np.uint8)
+        elif out.shape != shape or out.dtype != np.uint8:
+            raise vid.BatchShapeError('Expected a uint8 array of shape {}, got {} {}'.format(shape, out.dtype, out.shape))
+
+        for k, first, last in self.segment_ranges(start, stop):
+            position = self.offsets[k] + first - start
+            self.segments[k].read_batch(first, last, out=out[position:position + last - first])
+
+        return out
+
+    def decimate(self, start=0, stop=None, step=1, scale=1):
+        '''
+        Iterate over every step-th frame of the session in range(start, stop),
+        optionally downscaled. Same interface as Video.decimate.
+        '''
+        if stop is None:
+            stop = len(self)
+
+        for k, first, last in self.segment_ranges(start, stop, step):
+            yield from self.segments[k].decimate(first, last, step, scale=scale)
+
+    def chunk_jobs(self, first_frame, last_frame, chunk_size=None):
+        '''
+        Split the global frame range [first_frame, last_frame] into per-segment
+        chunks, so that every chunk is decoded from a single file.
+
+        Outputs:
+            jobs - list of (segment video, local first, local last) in order
+        '''
+        jobs = []
+        for k, first, last in self.segment_ranges(first_frame, last_frame + 1):
+            for a, b in vid.split_range(first, last - 1, chunk_size=chunk_size or (last - first)):
+                jobs.append((self.segments[k], a, b))
+        return jobs
+
+def parallel_frames(video, first_frame, last_frame, workers=None, chunk_size=None):
+    '''
+    Decode the frames [first_frame, last_frame] of a SegmentedVideo in parallel
+    worker processes, one segment chunk per task, and return the frames in order.
+
+    Inputs:
+        video - SegmentedVideo object
+        first_frame - global index of the first frame
+        last_frame - global index of the last frame (inclusive)
+        workers - number of worker processes, by default the number of cores
+        chunk_size - maximum number of frames per task, by default each segment
+            part is a single task
+
+    Outputs:
+        frames - generator of frames in frame order
+    '''
+    for chunk in vid.read_chunks(video.chunk_jobs(first_frame, last_frame, chunk_size), workers):
+        yield from chunk
+
+def parallel_stack(video, first_frame, last_frame, workers=None, chunk_size=None):
+    '''
+    Decode the frames [first_frame, last_frame] of a SegmentedVideo in parallel and
+    return them as a single contiguous array. See parallel_frames.
+    '''
+    jobs = video.chunk_jobs(first_frame, last_frame, chunk_size)
+    if not jobs:
+        return np.empty((0,) + video.frame_shape(), dtype=np.uint8)
+
+    return np.concatenate(list(vid.read_chunks(jobs, workers)))
@@ -0,0 +1,151 @@
+'''
+Decode-once grayscale frame store for a video.
+
+A video is decoded a single time into a raw uint8 file of shape (N, H, W) with a
+small JSON metadata sidecar. The store is then opened through numpy.memmap, so
+random access to any frame is a constant time read without decoding.
+'''
+import json
+import os
+
+import numpy as np
+
+from ota.video import video as vid
+
+# Extensions appended to the video path for the raw frames and the metadata sidecar
+STORE_EXTENSION = '.frames'
+METADATA_EXTENSION = '.json'
+
+def default_store_path(video_path):
+    '''
+    Returns the default location of the frame store of a video file.
+    '''
+    return os.path.abspath(video_path) + STORE_EXTENSION
+
+def create_frame_store(video_path, store_path=None):
+    '''
+    Decode every frame of a video as grayscale and write the frames to a raw
+    frame store on disk.
+
+    Inputs:
+        video_path - location of the video file
+        store_path - location of the raw frame file, by default the video path
+            with STORE_EXTENSION appended. The metadata is written next to it
+            with METADATA_EXTENSION appended.
+
+    Outputs:
+        store - FrameStore object opened on the new store
+    '''
+    video = vid.Video(video_path, grayscale=1)
+
+    if store_path is None:
+        store_path = default_store_path(video_path)
+    store_path = os.path.abspath(store_path)
+
+    frames = np.memmap(store_path, dtype=np.uint8, mode='w+', shape=(len(video), video.height, video.width))
+
+    # the frame count reported by the container can be too large, keep the
+    # frames that could actually be decoded
+    length = 0
+    try:
+        for frame in video[0:len(video)]:
+            frames[length] = frame
+            length += 1
+    except vid.ReadingImageError:
+        pass
+
+    frames.flush()
+    del frames
+
+    with open(store_path, 'r+b') as f:
+        f.truncate(length * video.height * video.width)
+
+    metadata = {'shape': [length, video.height, video.width],
+                'dtype': 'uint8',
+                'fps': video.fps,
+                'source': video.path,
+                'source_size': os.path.getsize(video.path),
+                'source_mtime': os.path.getmtime(video.path)}
+
+    with open(store_path + METADATA_EXTENSION, 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+    return FrameStore(store_path)
+
+def is_current(video_path, store_path=None):
+    '''
+    Returns True if a frame store exists for the video and was created from the
+    current version of the video file.
+    '''
+    if store_path is None:
+        store_path = default_store_path(video_path)
+
+    metadata_path = store_path + METADATA_EXTENSION
+    if not os.path.isfile(store_path) or not os.path.isfile(metadata_path):
+        return False
+
+    with open(metadata_path) as f:
+        metadata = json.load(f)
+
+    video_path = os.path.abspath(video_path)
+    return (metadata.get('source_size') == os.path.getsize(video_path) and
+            metadata.get('source_mtime') == os.path.getmtime(video_path))
+
+def open_video(video_path, **kwargs):
+    '''
+    Open a video, using its frame store when an up to date one exists.
+
+    Inputs:
+        video_path - location of the video file
+        kwargs - extra parameters passed on to Video when no store is used
+
+    Outputs:
+        video - FrameStore or Video object
+    '''
+    if is_current(video_path):
+        return FrameStore(default_store_path(video_path))
+    return vid.Video(video_path, **kwargs)
+
+class FrameStore(vid.ArrayVideo):
+    '''
+    Video-like access to a grayscale frame store created by create_frame_store.
+
+    Supports len(), indexing, slicing and iteration like Video. Frames are read
+    only views into the memory mapped file.
+    '''
+
+    def __init__(self, store_path):
+        '''
+        Open the frame store at the specified path.
+
+        Inputs:
+            store_path - location of the raw frame file
+        '''
+        metadata_path = store_path + METADATA_EXTENSION
+        if not os.path.isfile(store_path) or not os.path.isfile(metadata_path):
+            raise vid.VideoDoesNotExistError('The frame store {} does not exist'.format(store_path))
+
+        with open(metadata_path) as f:
+            self.metadata = json.load(f)
+
+        self.store_path = os.path.abspath(store_path)
+
+        vid.ArrayVideo.__init__(self, self.__open(), fps=self.metadata['fps'], path=self.metadata['source'])
+
+    def __open(self):
+        length, height, width = self.metadata['shape']
+        if length:
+            return np.memmap(self.store_path, dtype=self.metadata['dtype'], mode='r', shape=(length, height, width))
+        return np.zeros((0, height, width), dtype=self.metadata['dtype'])
+
+    def __getstate__(self):
+        '''
+        Pickle support. The memory map is reopened instead of copying the frames.
+        '''
+        state = self.__dict__.copy()
+        del state['frames']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.frames = self.__open()
@@ -2,6 +2,18 @@ import numpy as np
 import os
 import cv2
 import itertools
+import multiprocessing
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from ota import presets as pre
+
+# Largest gap (in frames) between the decoder position and the requested frame
+# that is bridged by grabbing frames instead of seeking. Seeking forces a decode
+# from the previous keyframe, so short forward gaps are cheaper to grab through.
+MAX_GRAB_GAP = 16
 
 class OutOfIndexError(Exception):
     '''
@@ -24,12 +36,132 @@ class VideoDoesNotExistError(Exception):
     def __init__(self, message):
         self.message = message
 
+class BatchShapeError(Exception):
+    '''
+    Output array does not match the shape or type of the requested frames.
+    '''
+    def __init__(self, message):
+        self.message = message
+
+class InvalidRegionError(Exception):
+    '''
+    Region of interest does not overlap the video frame.
+    '''
+    def __init__(self, message):
+        self.message = message
+
+def clip_roi(roi, height, width):
+    '''
+    Clip a region of interest to the frame bounds.
+
+    Inputs:
+        roi - (top, bottom, left, right) pixel bounds in full frame coordinates
+        height - frame height
+        width - frame width
+
+    Outputs:
+        roi - clipped (top, bottom, left, right) integer bounds
+    '''
+    top, bottom, left, right = (int(round(x)) for x in roi)
+    top, bottom = max(0, top), min(height, bottom)
+    left, right = max(0, left), min(width, right)
+
+    if bottom <= top or right <= left:
+        raise InvalidRegionError('The region {} does not overlap the {}x{} frame'.format(roi, width, height))
+
+    return top, bottom, left, right
+
+class FrameCache:
+    '''
+    Least recently used store of decoded frames bounded by a memory budget.
+
+    Frames are keyed by (video path, frame index, grayscale mode, region of interest),
+    so one cache can be shared by several videos, ie. the segments of a SegmentedVideo,
+    and frames cropped to different regions do not replace each other. Cached frames
+    are marked read-only so that a consumer cannot modify the copy seen by later
+    stages.
+    '''
+
+    def __init__(self, max_bytes):
+        '''
+        Inputs:
+            max_bytes - memory budget of the cache in bytes
+        '''
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.__frames = OrderedDict()
+        # a shared cache is used by the prefetch threads of several videos
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        '''
+        Return the number of cached frames.
+        '''
+        return len(self.__frames)
+
+    def __contains__(self, key):
+        return key in self.__frames
+
+    def get(self, key):
+        '''
+        Returns the cached frame for key, or None if it is not cached.
+        '''
+        with self.__lock:
+            frame = self.__frames.get(key)
+
+            if frame is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.__frames.move_to_end(key)
+
+        return frame
+
+    def put(self, key, frame):
+        '''
+        Store a frame, evicting the least recently used frames until the cache
+        fits within its memory budget. Frames larger than the budget are not stored.
+        '''
+        if frame.nbytes > self.max_bytes:
+            return
+
+        frame.flags.writeable = False
+
+        with self.__lock:
+            if key in self.__frames:
+                self.nbytes -= self.__frames.pop(key).nbytes
+
+            while self.__frames and self.nbytes + frame.nbytes > self.max_bytes:
+                self.nbytes -= self.__frames.popitem(last=False)[1].nbytes
+
+            self.__frames[key] = frame
+            self.nbytes += frame.nbytes
+
+    def clear(self):
+        '''
+        Remove all frames from the cache. Hit and miss counts are kept.
+        '''
+        with self.__lock:
+            self.__frames.clear()
+            self.nbytes = 0
+
+    def statistics(self):
+        '''
+        Returns a dictionary with the hit and miss counts and the memory in use.
+        '''
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'frames': len(self),
+                'bytes': self.nbytes}
+
 class Video:
     '''
     Object to represent a video and its associated metadata.
     '''
 
-    def __init__(self, path, grayscale=1):
+    def __init__(self, path, grayscale=1, max_grab_gap=MAX_GRAB_GAP, cache_size=0, prefetch_depth=0, roi=None):
         '''
         Create Video object from video file at specified path. By default images
         are grayscale.
@@ -37,6 +169,14 @@ class Video:
         Inputs:
             path - relative or absolute location of video file
             grayscale - returns images as grayscale
+            max_grab_gap - largest forward gap (in frames) that is skipped by
+                grabbing frames rather than seeking the decoder
+            cache_size - memory budget in bytes of the decoded frame cache, or a
+                FrameCache shared with other videos, the cache is disabled by default
+            prefetch_depth - number of frames decoded ahead on a worker thread
+                when iterating over a slice, prefetching is disabled by default
+            roi - (top, bottom, left, right) region of the frame returned by every
+                read, by default the full frame is returned
         '''
 
         # open video file
@@ -54,6 +194,31 @@ class Video:
 
         # optional parameters
         self.grayscale = grayscale
+        self.max_grab_gap = max_grab_gap
+        self.prefetch_depth = prefetch_depth
+
+        # serializes decoder and cache access between the consumer and the
+        # prefetch worker thread
+        self.__lock = threading.Lock()
+
+        # index of the frame the decoder will return on the next read,
+        # None when unknown (ie. after a failed read)
+        self.__position = 0
+
+        # decoder access counters
+        self.seek_count = 0
+        self.sequential_count = 0
+        self.grab_count = 0
+
+        # decoded frame cache, opt-in
+        self.cache = None
+        if isinstance(cache_size, FrameCache) or cache_size:
+            self.enable_cache(cache_size)
+
+        # eye region of interest, frames are cropped to it on read
+        self.roi = None
+        if roi is not None:
+            self.set_roi(roi)
 
     def __len__(self):
         '''
@@ -72,29 +237,330 @@ class Video:
         for i in range(len(self)):
             yield self[i]
 
-    def __read_next(self, index):
+    def __getstate__(self):
         '''
-        Returns the next frame at the specified index.
+        Pickle support. The capture handle, lock and frame cache are not sent, so a
+        Video can be passed to worker processes.
         '''
+        state = self.__dict__.copy()
+        del state['capture']
+        del state['_Video__lock']
+        state['cache'] = None
+        state['_Video__position'] = 0
+        return state
 
-        self.capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+    def __setstate__(self, state):
+        '''
+        Restore a pickled Video by reopening its own capture handle from self.path.
+        '''
+        self.__dict__.update(state)
+        self.capture = cv2.VideoCapture(self.path, 0)
+        self.__lock = threading.Lock()
+
+    def enable_cache(self, max_bytes):
+        '''
+        Keep decoded frames in memory so that repeated reads of a frame do not
+        decode it again. Least recently used frames are evicted once the cache
+        exceeds max_bytes.
+
+        Inputs:
+            max_bytes - memory budget of the cache in bytes, or a FrameCache
+                shared with other videos
+        '''
+        self.cache = max_bytes if isinstance(max_bytes, FrameCache) else FrameCache(max_bytes)
+
+    def disable_cache(self):
+        '''
+        Drop the decoded frame cache.
+        '''
+        self.cache = None
+
+    def set_roi(self, roi):
+        '''
+        Crop every frame read from the video to a region of interest. Coordinates
+        measured on cropped frames can be put back into full frame space with
+        roi_offset().
+
+        Inputs:
+            roi - (top, bottom, left, right) pixel bounds in full frame coordinates,
+                None to read full frames
+        '''
+        if roi is not None:
+            roi = clip_roi(roi, self.height, self.width)
+
+        self.roi = roi
+
+    def roi_offset(self):
+        '''
+        Returns the position of the top left corner of the region of interest in
+        full frame coordinates as a dictionary {'c': column index, 'r': row index}.
+        '''
+        if self.roi is None:
+            return {'c': 0, 'r': 0}
+        return {'c': self.roi[2], 'r': self.roi[0]}
+
+    def __read(self, index, max_gap=None):
+        '''
+        Returns the frame at the specified index, from the frame cache if possible.
+        '''
+        with self.__lock:
+            return self.__read_cached(index, max_gap)
+
+    def __read_cached(self, index, max_gap=None):
+        if self.cache is None:
+            return self.__read_next(index, max_gap)
+
+        key = (self.path, index, self.grayscale, self.roi)
+        image = self.cache.get(key)
+
+        if image is None:
+            image = self.__read_next(index, max_gap)
+            self.cache.put(key, image)
+
+        return image
+
+    def __read_next(self, index, max_gap=None):
+        '''
+        Returns the next frame at the specified index.
+
+        The decoder is only repositioned when the requested frame is not the next
+        frame in the stream. Forward gaps of up to max_gap frames (by default
+        max_grab_gap) are bridged with grab() and everything else falls back to a seek.
+        '''
 
         if len(self) < index or index < 0:
             raise OutOfIndexError('Please specify an index within 0 and {}'.format(len(self)))
 
+        self.__seek(index, self.max_grab_gap if max_gap is None else max_gap)
+
         retval, image = self.capture.read()
 
         if not retval:
+            self.__position = None
             raise ReadingImageError('Could not read current frame.')
 
+        self.__position = index + 1
+
+        # crop before the colour conversion so that only the region is converted
+        if self.roi is not None:
+            top, bottom, left, right = self.roi
+            image = image[top:bottom, left:right]
+
         if self.grayscale == 1:
             return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         else:
-            return image
+            # copy the cropped region so the full frame can be released
+            return np.ascontiguousarray(image)
+
+    def __seek(self, index, max_gap):
+        '''
+        Position the decoder so that the next read returns the frame at index.
+        '''
+        gap = None if self.__position is None else index - self.__position
+
+        if gap == 0:
+            self.sequential_count += 1
+        elif gap is not None and 0 < gap <= max_gap:
+            for _ in range(gap):
+                if not self.capture.grab():
+                    self.__position = None
+                    raise ReadingImageError('Could not grab frame {}.'.format(index - gap))
+            self.grab_count += gap
+            self.sequential_count += 1
+        else:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+            self.seek_count += 1
+
+    def frame_shape(self):
+        '''
+        Returns the shape of the frames returned by reads, taking the region of
+        interest and grayscale mode into account.
+        '''
+        if self.roi is None:
+            shape = (self.height, self.width)
+        else:
+            shape = (self.roi[1] - self.roi[0], self.roi[3] - self.roi[2])
+        return shape if self.grayscale == 1 else shape + (3,)
+
+    def read_batch(self, start, stop, out=None):
+        '''
+        Decode the frames in range(start, stop) into a contiguous uint8 stack. The
+        decoder reuses a single colour buffer and the grayscale conversion writes
+        straight into the stack, so no per frame arrays are allocated. Batches are
+        read from the decoder and bypass the frame cache.
+
+        Inputs:
+            start - index of the first frame
+            stop - index after the last frame
+            out - optional preallocated (stop - start, H, W) uint8 array to fill,
+                (stop - start, H, W, 3) for colour videos
+
+        Outputs:
+            out - the filled (stop - start, H, W) array
+        '''
+        if start < 0 or stop > len(self) or stop < start:
+            raise OutOfIndexError('Please specify a range within 0 and {}'.format(len(self)))
+
+        shape = (stop - start,) + self.frame_shape()
+        if out is None:
+            out = np.empty(shape, dtype=np.uint8)
+        elif out.shape != shape or out.dtype != np.uint8:
+            raise BatchShapeError('Expected a uint8 array of shape {}, got {} {}'.format(shape, out.dtype, out.shape))
+
+        if stop == start:
+            return out
+
+        with self.__lock:
+            self.__seek(start, self.max_grab_gap)
+            self.sequential_count += stop - start - 1
+
+            buffer = None
+            for i in range(stop - start):
+                retval, buffer = self.capture.read(buffer)
+
+                if not retval:
+                    self.__position = None
+                    raise ReadingImageError('Could not read frame {}.'.format(start + i))
+
+                image = buffer
+                if self.roi is not None:
+                    top, bottom, left, right = self.roi
+                    image = buffer[top:bottom, left:right]
+
+                if self.grayscale == 1:
+                    cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=out[i])
+                else:
+                    out[i] = image
+
+            self.__position = stop
+
+        return out
+
+    def read_statistics(self):
+        '''
+        Returns a dictionary with the number of decoder seeks, sequential reads and
+        grabbed (skipped) frames performed by this video so far.
+        '''
+        return {'seeks': self.seek_count,
+                'sequential': self.sequential_count,
+                'grabbed': self.grab_count}
+
+    def prefetch(self, start=0, stop=None, step=1, depth=pre.PREFETCH_DEPTH):
+        '''
+        Iterate over the frames in range(start, stop, step) while a worker thread
+        decodes up to depth frames ahead of the consumer. OpenCV releases the GIL
+        while decoding, so decoding overlaps with the processing of earlier frames.
+
+        The worker stops as soon as the consumer stops iterating (or the generator
+        is closed). Errors raised while reading are passed on to the consumer as
+        OutOfIndexError or ReadingImageError.
+
+        ex.
+            for frame in v.prefetch(0, 100, depth=16):
+                ...
+
+        Inputs:
+            start - index of the first frame
+            stop - index after the last frame, by default the length of the video
+            step - step between frame indices
+            depth - maximum number of decoded frames waiting to be consumed
+        '''
+        if stop is None:
+            stop = len(self)
+
+        frames = queue.Queue(maxsize=max(1, depth))
+        done = threading.Event()
+        end = object()
+
+        def put(item):
+            # block until the item is queued or the consumer has stopped
+            while not done.is_set():
+                try:
+                    frames.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                for ii in range(start, stop, step):
+                    if not put(self.__read(ii)):
+                        return
+            except (OutOfIndexError, ReadingImageError) as error:
+                put(error)
+            except Exception as error:
+                put(ReadingImageError('Could not read frame: {}'.format(error)))
+            put(end)
+
+        def gen():
+            thread = threading.Thread(target=worker, daemon=True)
+            thread.start()
+            try:
+                while True:
+                    item = frames.get()
+                    if item is end:
+                        return
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+            finally:
+                done.set()
+                thread.join()
+
+        return gen()
+
+    def decimate(self, start=0, stop=None, step=1, scale=1):
+        '''
+        Iterate over every step-th frame in range(start, stop), for previews and sparse
+        sampling. The frames skipped between two reads are either grabbed or jumped
+        over with a keyframe seek, whichever was measured to be cheaper for this
+        stride: the second read is done with a seek, the third by grabbing, and the
+        faster of the two is used (and re-timed) for the rest of the iteration.
+
+        Inputs:
+            start - index of the first frame
+            stop - index after the last frame, by default the length of the video
+            step - number of frames between two returned frames
+            scale - factor by which returned frames are downscaled, ie. 0.25 returns
+                quarter size thumbnails
+
+        Outputs:
+            frames - generator of (optionally downscaled) frames
+        '''
+        if stop is None:
+            stop = len(self)
+
+        gap = step - 1
+        durations = {}
+
+        for n, ii in enumerate(range(start, stop, step)):
+            if gap == 0 or n == 0:
+                method = None
+            elif 'seek' not in durations:
+                method = 'seek'
+            elif 'grab' not in durations:
+                method = 'grab'
+            else:
+                method = min(durations, key=durations.get)
+
+            tic = time.perf_counter()
+            image = self.__read(ii, {None: None, 'seek': -1, 'grab': gap}[method])
+
+            # exponential moving average of the cost of a read with each method
+            if method is not None:
+                duration = time.perf_counter() - tic
+                durations[method] = 0.8 * durations.get(method, duration) + 0.2 * duration
+
+            if scale != 1:
+                image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+            yield image
 
     def __getitem__(self, index):
         '''
-        Array-like access for Video object.
+        Array-like access for Video object. Slices return a generator, which decodes
+        ahead on a worker thread when prefetch_depth is set.
 
         ex. v[0] or v[1:10]
         '''
@@ -102,17 +568,234 @@ class Video:
         # temp generator so that we can return both an image or a generator
         def gen(start, stop, step):
             for ii in range(start, stop, step):
-                yield self.__read_next(ii)
+                yield self.__read(ii)
 
         # if users wants a slice return an iterable generator
         if isinstance( index, slice ):
+            if self.prefetch_depth:
+                return self.prefetch(*index.indices(len(self)), depth=self.prefetch_depth)
             return gen(*index.indices(len(self)))
         # otherwise, return the image
         else:
-            return self.__read_next(index)
+            return self.__read(index)
 
     def elapsed_time(self):
         '''
         Returns current position of video file in milliseconds.
         '''
         return self.capture.get(cv2.CAP_PROP_POS_MSEC)
+
+class ArrayVideo:
+    '''
+    Video-like object backed by frames held in memory, for synthetic and test data.
+
+    Supports len(), indexing, slicing, iteration, fps, width and height like Video,
+    so it can be passed to the analysis pipeline and the scroll viewers unchanged.
+    Slices return views of the underlying array.
+    '''
+
+    def __init__(self, frames, fps=30, path=None):
+        '''
+        Create an ArrayVideo object from a series of frames.
+
+        Inputs:
+            frames - (N, H, W) grayscale or (N, H, W, 3) colour array, or a list of
+                equally sized frames
+            fps - frame rate reported for the frames
+            path - optional source location reported as the video path
+        '''
+        self.frames = frames if isinstance(frames, np.ndarray) else np.stack(frames)
+        self.path = path
+        self.fps = fps
+        self.height = self.frames.shape[1]
+        self.width = self.frames.shape[2]
+        self.grayscale = 1 if self.frames.ndim == 3 else 0
+        self.roi = None
+
+    def __len__(self):
+        '''
+        Return the number of frames.
+        '''
+        return len(self.frames)
+
+    def __iter__(self):
+        '''
+        Object iteration.
+        '''
+        return iter(self.__crop(self.frames, stacked=True))
+
+    def __crop(self, frames, stacked):
+        if self.roi is None:
+            return frames
+        top, bottom, left, right = self.roi
+        if stacked:
+            return frames[:, top:bottom, left:right]
+        return frames[top:bottom, left:right]
+
+    def __getitem__(self, index):
+        '''
+        Array-like access for ArrayVideo object. Slices return a (n, H, W) view.
+
+        ex. v[0] or v[1:10]
+        '''
+        if isinstance(index, slice):
+            return self.__crop(self.frames[index], stacked=True)
+
+        if len(self) <= index or index < 0:
+            raise OutOfIndexError('Please specify an index within 0 and {}'.format(len(self)))
+
+        return self.__crop(self.frames[index], stacked=False)
+
+    def set_roi(self, roi):
+        '''
+        Crop every frame read to a region of interest. Cropped frames are views into
+        the underlying array.
+
+        Inputs:
+            roi - (top, bottom, left, right) pixel bounds in full frame coordinates,
+                None to read full frames
+        '''
+        if roi is not None:
+            roi = clip_roi(roi, self.height, self.width)
+        self.roi = roi
+
+    def roi_offset(self):
+        '''
+        Returns the position of the top left corner of the region of interest in
+        full frame coordinates as a dictionary {'c': column index, 'r': row index}.
+        '''
+        if self.roi is None:
+            return {'c': 0, 'r': 0}
+        return {'c': self.roi[2], 'r': self.roi[0]}
+
+    def frame_shape(self):
+        '''
+        Returns the shape of the frames returned by reads, taking the region of
+        interest into account.
+        '''
+        return self[0].shape if len(self) else self.frames.shape[1:]
+
+    def read_batch(self, start, stop, out=None):
+        '''
+        Copy the frames in range(start, stop) into a contiguous stack. Same interface
+        as Video.read_batch.
+        '''
+        if start < 0 or stop > len(self) or stop < start:
+            raise OutOfIndexError('Please specify a range within 0 and {}'.format(len(self)))
+
+        frames = self[start:stop]
+        if out is None:
+            return np.ascontiguousarray(frames)
+        if out.shape != frames.shape or out.dtype != frames.dtype:
+            raise BatchShapeError('Expected a {} array of shape {}, got {} {}'.format(frames.dtype, frames.shape, out.dtype, out.shape))
+
+        np.copyto(out, frames)
+        return out
+
+    def decimate(self, start=0, stop=None, step=1, scale=1):
+        '''
+        Iterate over every step-th frame in range(start, stop), optionally downscaled
+        by scale. Same interface as Video.decimate.
+        '''
+        for image in self[start:stop:step]:
+            if scale != 1:
+                image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            yield image
+
+def split_range(first_frame, last_frame, num_chunks=None, chunk_size=None):
+    '''
+    Split the frame range [first_frame, last_frame] into contiguous chunks.
+
+    Inputs:
+        first_frame - index of the first frame
+        last_frame - index of the last frame (inclusive)
+        num_chunks - number of chunks, ignored if chunk_size is given
+        chunk_size - number of frames per chunk
+
+    Outputs:
+        chunks - list of (first, last) inclusive frame ranges in order
+    '''
+    num_frames = last_frame - first_frame + 1
+    if num_frames <= 0:
+        return []
+
+    if chunk_size is None:
+        chunk_size = -(-num_frames // max(1, num_chunks or 1))
+
+    return [(i, min(i + chunk_size - 1, last_frame)) for i in range(first_frame, last_frame + 1, chunk_size)]
+
+def _read_chunk(args):
+    '''
+    Decode the inclusive frame range of a chunk as a (n, H, W) or (n, H, W, 3) array.
+    Executed in a worker process with its own copy of the video.
+    '''
+    video, first, last = args
+    return video.read_batch(first, last + 1)
+
+def read_chunks(jobs, workers=None):
+    '''
+    Decode chunks of frames in parallel worker processes, each with its own capture
+    handle, and return the decoded chunks in order. At most two chunks per worker
+    are decoded ahead of the consumer.
+
+    Inputs:
+        jobs - list of (video, first, last) inclusive frame ranges to decode
+        workers - number of worker processes, by default the number of cores
+
+    Outputs:
+        chunks - generator of (n, H, W) arrays in job order
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    with multiprocessing.Pool(workers) as pool:
+        pending = []
+        for job in jobs:
+            pending.append(pool.apply_async(_read_chunk, (job,)))
+            if len(pending) >= 2 * workers:
+                yield pending.pop(0).get()
+        for result in pending:
+            yield result.get()
+
+def parallel_frames(video, first_frame, last_frame, workers=None, chunk_size=None):
+    '''
+    Decode the frames [first_frame, last_frame] in parallel worker processes. The
+    range is split into contiguous chunks, each chunk is decoded by a worker with its
+    own capture handle, and frames are returned in order. See read_chunks.
+
+    Inputs:
+        video - Video (or any picklable video-like) object
+        first_frame - index of the first frame
+        last_frame - index of the last frame (inclusive)
+        workers - number of worker processes, by default the number of cores
+        chunk_size - number of frames decoded by a worker at once, by default the
+            range is split into four chunks per worker
+
+    Outputs:
+        frames - generator of frames in frame order
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    chunks = split_range(first_frame, last_frame, num_chunks=4 * workers, chunk_size=chunk_size)
+
+    for chunk in read_chunks([(video, first, last) for first, last in chunks], workers):
+        yield from chunk
+
+def parallel_stack(video, first_frame, last_frame, workers=None, chunk_size=None):
+    '''
+    Decode the frames [first_frame, last_frame] in parallel worker processes and
+    return them as a single contiguous array. See parallel_frames.
+
+    Outputs:
+        frames - (n, H, W) array of grayscale frames, (n, H, W, 3) for colour
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    chunks = split_range(first_frame, last_frame, num_chunks=4 * workers, chunk_size=chunk_size)
+
+    if not chunks:
+        return np.empty((0,) + video.frame_shape(), dtype=np.uint8)
+
+    return np.concatenate(list(read_chunks([(video, first, last) for first, last in chunks], workers)))